@@ -0,0 +1,183 @@
+#!/bin/python
+# Times the main operations of bf2f on synthetic data (see
+# bf2f.synthetic_triples), for every energy type, and writes the results
+# as JSON: best seconds per call, and items (triples, chains, ...) per
+# second. Given the JSON of an earlier run, also reports what got slower.
+# usage: python benchmark-bf2.py out.json [W=1000] [R=10] [d=50] [N=50000]
+#            [baseline=old.json] [data=synthetic.bin]
+import bf2f as bf2f
+import numpy as np
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+# --- settings (override on the command line as key=value) --- #
+settings = {'W':1000, 'R':10, 'd':50, 'N':50000,
+            # batch size, chains, Gibbs iterations
+            'B':100, 'M':100, 'K':1,
+            # best of how many calls (slow operations get fewer)
+            'repeats':5,
+            'seed':1337,
+            # report throughputs below 1/slower of the baseline's
+            'slower':1.2,
+            'baseline':None,
+            # where to keep the synthetic data (default: thrown away)
+            'data':None}
+
+if len(sys.argv) < 2 or '=' in sys.argv[1]:
+    sys.exit('usage: python benchmark-bf2.py out.json [W=1000] [R=10] [d=50] [N=50000] [baseline=old.json] [data=synthetic.bin]')
+out_path = sys.argv[1]
+for arg in sys.argv[2:]:
+    key, value = arg.split('=', 1)
+    if not key in settings:
+        sys.exit('ERROR: unknown setting '+key)
+    if type(settings[key]) == int:
+        value = int(value)
+    elif type(settings[key]) == float:
+        value = float(value)
+    settings[key] = value
+W, R, d, N = settings['W'], settings['R'], settings['d'], settings['N']
+B, M, K = settings['B'], settings['M'], settings['K']
+repeats = settings['repeats']
+
+def time_call(function, items, repeats=repeats):
+    """
+    Best time of a few calls to function (it takes no arguments), and
+    the throughput that makes, given it deals with this many items.
+    """
+    best = np.inf
+    for i in xrange(repeats):
+        t0 = time.time()
+        function()
+        best = min(best, time.time() - t0)
+    return {'seconds':best, 'items':items, 'per_second':items/max(best, 1e-9)}
+
+def start_parameters(rng):
+    """
+    Small random (C, G, V), as run-bf2.py starts training from.
+    """
+    C = rng.normal(scale=0.1, size=(W, d+1))
+    V = rng.normal(scale=0.1, size=(W, d+1))
+    C[:, -1] = 1
+    V[:, -1] = 1
+    G = np.zeros(shape=(R, d+1, d+1))
+    G[:] = np.eye(d+1)
+    G[:, :-1, :] += rng.normal(scale=0.01, size=(R, d, d+1))
+    return C, G, V
+
+def train_options(name, etype):
+    """
+    PCD training without diagnostics (so we time the training itself).
+    """
+    return {'dimension':d, 'batch_size':B, 'sampling_rate':B, 'num_samples':M,
+            'gibbs_iterations':K, 'diagnostics_rate':0, 'calculate_ll':False,
+            'ais_chains':0, 'ais_temperatures':0, 'vali_set_size':min(1000, N/10),
+            'alpha':np.array([0.001]*3), 'mu':np.array([0.9]*3),
+            'nu':np.array([0.999]*3), 'tau':np.array([0]*3), 'offset':0,
+            'name':name, 'etype':etype}
+
+def benchmark(etype, data_path, scratch):
+    """
+    Times everything for one energy type.
+    """
+    rng = np.random.RandomState(settings['seed'])
+    np.random.seed(settings['seed'])
+    triples = bf2f.data_stream(data_path).acquire_all(settings['seed'])
+    triples = np.asarray(triples)
+    parameters = bf2f.params(start_parameters(rng), etype=etype)
+    omega = np.ones(R)
+    batch = triples[rng.choice(len(triples), B)]
+    chains = triples[rng.choice(len(triples), M)]
+    alpha = np.array([0.001]*3)
+    mu = np.array([0.9]*3)
+    nu = np.array([0.999]*3)
+    grads = bf2f.combine_gradients(bf2f.batch_gradient(parameters, batch, omega),
+                                   bf2f.batch_gradient(parameters, chains, omega),
+                                   float(B)/M)
+    n_E = min(len(triples), 10000)
+    timings = {}
+    timings['E'] = time_call(lambda: parameters.E(triples[:n_E]), n_E)
+    timings['grad_E'] = time_call(lambda: parameters.grad_E(batch), B)
+    timings['batch_gradient'] = time_call(lambda: bf2f.batch_gradient(parameters, batch, omega), B)
+    timings['batch_gradient_sparse'] = time_call(lambda: bf2f.batch_gradient(parameters, batch, omega, True), B)
+    timings['sample'] = time_call(lambda: parameters.sample(chains[0], K), 1)
+    timings['sample_chains'] = time_call(lambda: parameters.sample_chains(chains, K), M)
+    timings['update'] = time_call(lambda: parameters.update(grads, alpha, mu, nu), 1)
+    # (throughput in energies summed for log Z)
+    timings['log_likelihood'] = time_call(lambda: bf2f.log_likelihood(parameters, triples[:n_E]),
+                                          W*R*W, repeats=1)
+    # end to end, on the file itself (less the held-out triples)
+    options = train_options(os.path.join(scratch, etype), etype)
+    train_data = bf2f.data_stream(data_path).acquire_all(settings['seed'])
+    start = start_parameters(rng)
+    timings['train'] = time_call(lambda: bf2f.train(train_data, start, dict(options),
+                                                    VERBOSE=False),
+                                 len(triples) - options['vali_set_size'], repeats=1)
+    return timings
+
+def regressions(baseline, results, slower):
+    """
+    (etype, operation, ratio) for everything whose throughput fell below
+    1/slower of the baseline's.
+    """
+    found = []
+    for etype in sorted(results):
+        for operation in sorted(results[etype]):
+            try:
+                before = baseline['results'][etype][operation]['per_second']
+            except KeyError:
+                continue
+            ratio = results[etype][operation]['per_second']/before
+            if ratio < 1.0/slower:
+                found.append((etype, operation, ratio))
+    return found
+
+# --- synthetic data --- #
+scratch = tempfile.mkdtemp(prefix='bf2bench')
+data_path = settings['data']
+if data_path is None:
+    data_path = os.path.join(scratch, 'synthetic.bin')
+print 'Generating', N, 'triples: W =', W, 'R =', R, 'd =', d
+t0 = time.time()
+triples, planted = bf2f.synthetic_triples(W, R, N, d, seed=settings['seed'])
+bf2f.write_triples(data_path, triples, W, R, binary=not data_path.endswith(('.txt', '.gz')))
+print 'Wrote', data_path, 'in', '%.1f' % (time.time() - t0), 's'
+
+# --- benchmarks --- #
+results = {}
+for etype in sorted(bf2f.ENERGIES):
+    print 'Benchmarking', etype
+    results[etype] = benchmark(etype, data_path, scratch)
+    for operation in sorted(results[etype]):
+        timing = results[etype][operation]
+        print '\t', operation.ljust(24), '%.4f s' % timing['seconds'], '\t%.1f /s' % timing['per_second']
+shutil.rmtree(scratch)
+
+report = {'settings':settings,
+          'kernels':bf2f.use_kernels(),
+          'numpy':np.__version__,
+          'python':platform.python_version(),
+          'machine':platform.platform(),
+          'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+          'results':results}
+fo = open(out_path, 'w')
+json.dump(report, fo, indent=1, sort_keys=True)
+fo.close()
+print 'Wrote', out_path
+
+# --- compare to an earlier run --- #
+if not settings['baseline'] is None:
+    baseline = json.load(open(settings['baseline'], 'r'))
+    for key in ['W', 'R', 'd', 'N', 'B', 'M', 'K']:
+        if not baseline['settings'][key] == settings[key]:
+            print 'WARNING: baseline has', key, '=', baseline['settings'][key]
+    slow = regressions(baseline, results, settings['slower'])
+    for (etype, operation, ratio) in slow:
+        print 'SLOWER:', etype, operation, '%.2fx the baseline throughput' % ratio
+    if len(slow) > 0:
+        sys.exit('ERROR: '+str(len(slow))+' benchmarks slower than the baseline.')
+    print 'No regressions against', settings['baseline']
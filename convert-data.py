@@ -0,0 +1,14 @@
+#!/bin/python
+# Converts a text training file ('W R' header, then 's r t' lines, maybe
+# gzipped) into the binary format that bf2f.data_stream memory-maps.
+# usage: python convert-data.py in.txt.gz out.bin
+import bf2f as bf2f
+import sys
+import time
+
+if not len(sys.argv) == 3:
+    sys.exit('usage: python convert-data.py in.txt[.gz] out.bin')
+in_path, out_path = sys.argv[1:3]
+t0 = time.time()
+N = bf2f.convert_triples(in_path, out_path)
+print 'Wrote', N, 'triples to', out_path, 'in', '%.1f' % (time.time() - t0), 's'
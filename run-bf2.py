@@ -110,9 +110,19 @@ else:
     S = 100
     M = 5
     D = 1000
+    diagnostics_backlog = 2                         # 0: diagnostics in line
+    diagnostics_drop = False                        # skip lines rather than wait
+    ais_chains, ais_temperatures = 100, 100         # AIS log Z budget (0: none)
+    rank_eval = False                               # MR/MRR/hits@k on held-out set
+    rank_filtered = True                            # ...ignoring other known triples
+    reject_known = False                            # NOISE samples never known triples
+    noise = 'uniform'                               # or 'unigram', 'relation'
+    noise_power = 0.75                              # (for 'unigram')
+    noise_objective = 'contrast'                    # or 'nce'
     K = 1
     d = 100
     vali_set_size = 3
+    vali_method = 'random'
     alphaC, alphaG, alphaV = 0.01, 0.01, 0.01
     muC, muG, muV = 0.9, 0.9, 0.9
     nuC, nuG, nuV = 0.999, 0.999, 0.999           # nu required for Adam
@@ -120,11 +130,31 @@ else:
     fix_words = False
     fix_relas = False
     trans_rela = True
+    relations = 'dense'                             # or 'translation': G[r] = I + offset
+    relation_rank = 10                              # 'lowrank': G[r] = diag + rank-k
+    sparse_updates = False
+    projection_cache = False                        # keep G[r]V for every r
+    dtype = 'float64'                               # or 'float32' for C, G, V
+    state_dtype = 'float64'                         # ...and for the optimiser
+    kernels = None                                  # 'numpy' or 'numba' (None: numba if installed)
+    n_workers = 1
+    shuffle_seed = None                             # set, to be able to resume
+    resume = None                                   # path to a .ckpt, to resume
     n_epochs = 1
     offset = 0
     options = {'dimension':d,
                'batch_size':B,
                'diagnostics_rate':D,
+               'diagnostics_backlog':diagnostics_backlog,
+               'diagnostics_drop':diagnostics_drop,
+               'ais_chains':ais_chains,
+               'ais_temperatures':ais_temperatures,
+               'rank_eval':rank_eval,
+               'rank_filtered':rank_filtered,
+               'reject_known':reject_known,
+               'noise':noise,
+               'noise_power':noise_power,
+               'noise_objective':noise_objective,
                'sampling_rate':S,
                'gibbs_iterations':K,
                'num_samples':M,
@@ -134,12 +164,27 @@ else:
                'tau':bf2f.np.array([tauC, tauG, tauV]),
                'calculate_ll':CALC_LL,
                'vali_set_size':vali_set_size,
+               'vali_method':vali_method,
                'fix_words':fix_words,
                'fix_relas':fix_relas,
                'trans_rela':trans_rela,
+               'relations':relations,
+               'relation_rank':relation_rank,
+               'etype':etype,
+               'sparse_updates':sparse_updates,
+               'projection_cache':projection_cache,
+               'dtype':dtype,
+               'state_dtype':state_dtype,
+               'kernels':kernels,
+               'n_workers':n_workers,
+               'shuffle_seed':shuffle_seed,
+               'resume':resume,
                'n_epochs':n_epochs,
                'offset':offset}
     # note that some of these options are not used by bf2f
+etype = options.get('etype', etype)
+if not options.get('kernels', None) in [None, 'None']:
+    bf2f.KERNELS = options['kernels']
 
 outpath = '/cbio/grlab/home/hyland/git/bri-focal/v2/output/'
 if 'name' in options:
@@ -263,9 +308,21 @@ else:
     V = bf2f.np.random.normal(scale=0.1, size=(W, d+1))
 
 G = bf2f.np.random.normal(scale=0.01, size=(R, d+1, d+1))
+if options.get('relations', 'dense') == 'translation':
+    # (just the offsets are random)
+    G[:, :, :-1] = bf2f.np.eye(d+1)[:, :-1]
 G[0, :, :] = bf2f.np.eye(d+1)
 G[:, -1, :] = 0
 G[:, -1, -1] = 1
+if options.get('relations', 'dense') == 'lowrank':
+    # (random factors: converting the dense G would keep only its best rank k)
+    k = options['relation_rank']
+    G = bf2f.np.random.normal(scale=0.1, size=(R, 1+2*k, d+1))
+    G[:, 0, :] = bf2f.np.random.normal(scale=0.01, size=(R, d+1))
+    G[0, :, :] = 0
+    G[0, 0, :] = 1
+    G[:, 0, -1] = 1
+    G[:, 1:1+k, -1] = 0
 C[:,-1] = 1
 V[:,-1] = 1
 
@@ -299,34 +356,90 @@ except NameError:
 
 vocab = {'words':words, 'relas': relas}
 
+# --- resuming? --- #
+resume = options.get('resume', None)
+if resume in [None, 'None']:
+    resume_state = None
+    first_epoch = 0
+    shuffle_seed = options.get('shuffle_seed', None)
+    if shuffle_seed in [None, 'None']:
+        # pick one anyway, so the checkpoints can be resumed
+        shuffle_seed = bf2f.np.random.randint(2**31 - 1)
+else:
+    print 'Resuming from', resume
+    pp, resume_state = bf2f.resume_state(resume)
+    first_epoch = resume_state['epoch']
+    shuffle_seed = resume_state['shuffle_seed']
+options['shuffle_seed'] = shuffle_seed
+
+def epoch_seed(epoch):
+    # each epoch gets its own (reproducible) shuffle
+    return (shuffle_seed + epoch) % (2**32)
+
 # --- actually get the training data --- #
 if ONLINE:
-    train_data = dstream
+    if first_epoch == 0:
+        train_data = dstream
+    else:
+        train_data = dstream.acquire_all(epoch_seed(first_epoch))
 else:
-    train_data = dstream.acquire_all()
+    # (shuffled once, for all epochs)
+    train_data = dstream.acquire_all(epoch_seed(0))
 
 # --- initialise parameters --- #
-pp = bf2f.params((C, G, V), vocab, fix_words=fix_words, fix_relas=fix_relas, trans_rela=trans_rela)
+if resume_state is None:
+    pp = bf2f.params((C, G, V), vocab, fix_words=fix_words, fix_relas=fix_relas, trans_rela=trans_rela,
+                     cache=options.get('projection_cache', False),
+                     dtype=options.get('dtype', None), state_dtype=options.get('state_dtype', None),
+                     relations=options.get('relations', None),
+                     relation_rank=options.get('relation_rank', None),
+                     etype=etype)
+
+if bf2f.use_kernels():
+    # (compiled kernels against the numpy reference, on these parameters)
+    print 'kernel parity:', bf2f.check_kernels(pp)
 
 # --- ll before --- #
 if CALC_LL:
     print 'pre ll:', bf2f.log_likelihood(pp, train_data)
 
 # --- start the logfile --- #
-if DIAGNOSTICS:
+if not DIAGNOSTICS:
+    print 'WARNING: no diagnostics.'
+elif resume_state is None:
+    # (a resumed run appends to the files it was writing)
     logf = open(fname+'_logfile.txt','w')
     logf.write('n\ttime\tll\tdata_energy\tmodel_energy\tvaliset_energy\trandom_energy\tperm_energy\tC_lens\tG_lens\tV_lens\n')
     logf.close()
-else:
-    print 'WARNING: no diagnostics.'
+    if not CALC_LL and options.get('ais_chains', 0) > 0:
+        # (the ll column is then the held-out set's, from an AIS estimate of log Z)
+        aisf = open(fname+'_ais.txt','w')
+        aisf.write('n\tlogZ\tlogZ_err\tll\tll_err\n')
+        aisf.close()
+    if options.get('rank_eval', False):
+        rankf = open(fname+'_ranks.txt','w')
+        rankf.write('\t'.join(['n'] + bf2f.RANK_COLUMNS)+'\n')
+        rankf.close()
 
 # ---- TRAIN! --- #
-for epoch in xrange(n_epochs):
+# (the held-out set is chosen once, and kept for later epochs)
+vali_set = None
+for epoch in xrange(first_epoch, n_epochs):
     print 'epoch:', epoch
-    cProfile.runctx('vali_set = bf2f.train(train_data, pp, options, EXACT, PERSISTENT, NOISE)', None, locals())
+    options['epoch'] = epoch
+    if options.get('n_workers', 1) > 1:
+        # hogwild (no EXACT, no profiling: the work is in the workers)
+        assert not EXACT
+        if not resume_state is None:
+            sys.exit('ERROR: hogwild training (n_workers > 1) cannot resume from a checkpoint.')
+        vali_set = bf2f.train_hogwild(train_data, pp, options, options['n_workers'], PERSISTENT, NOISE,
+                                      vali_set=vali_set)
+    else:
+        cProfile.runctx('vali_set = bf2f.train(train_data, pp, options, EXACT, PERSISTENT, NOISE, vali_set=vali_set, resume=resume_state)', None, locals())
+    resume_state = None
     if ONLINE:
         # (the purpose of this is to shuffle the training data)
-        train_data = dstream.acquire_all()
+        train_data = dstream.acquire_all(epoch_seed(epoch + 1))
 
 # --- save n stuff --- #
 C_out, G_out, V_out = pp.get()
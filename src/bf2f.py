@@ -5,16 +5,25 @@ import numpy as np
 # DO NOT PLAY NICE WITH NANS
 np.seterr(all='raise')
 np.seterr(under='warn')
-from copy import deepcopy
+from copy import copy, deepcopy
 import sys
 import gzip
 import time
 import re
+import os
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+import Queue
+import json
 from copy import deepcopy
 #import pathos.multiprocessing as mp
-# yolo
-from thresholds_fn import devset_accuracy
 from math import pi
+try:
+    # (optional: compiled kernels, see KERNELS)
+    import numba
+except ImportError:
+    numba = None
 
 # --- CONSTANTS --- #
 THEANO=False
@@ -35,10 +44,35 @@ if ADAM:
     LAMBDA=(1-1e-8)
 # normalise vectors to 1, matrices to have max element = 1 (weird, weird)
 NORMALISE=False
-# energy type
+# binary triple files: magic, then int64 W, R, N, then an int32 (N, 3) array
+TRIPLES_MAGIC='BF2TRIPL'
+TRIPLES_HEADER=32
+# text files are parsed in blocks of this many bytes, by worker processes
+# if the file is bigger than INGEST_PARALLEL_BYTES (and we have the cores)
+INGEST_BLOCK_BYTES=2**24
+INGEST_PARALLEL_BYTES=2**26
+# checkpoint files: magic, int64 header length, JSON header, then arrays
+CHECKPOINT_MAGIC='BF2CKPT1'
+CHECKPOINT_ALIGN=64
+# link prediction metrics (see evaluate_ranking), in logfile order
+RANK_COLUMNS=['MR', 'MRR', 'hits@1', 'hits@3', 'hits@10']
+# kernels for the Gibbs sweep, categorical draws and group sums: 'numpy'
+# (the reference), 'numba' (compiled), or None for numba if it's installed
+KERNELS=None
+# everything params needs to carry on training where it left off
+STATE_ARRAYS=['C', 'G', 'V', 'C_vel', 'G_vel', 'V_vel', 'C_acc', 'G_acc', 'V_acc',
+              'C_last', 'G_last', 'V_last', 'clock']
+# energy type (the default: params(..., etype=...) picks one per model,
+# see ENERGIES)
 #ETYPE='euclidean'
 ETYPE='dot'
 #ETYPE='angular'
+# rough upper bound (in bytes) on the temporaries made by the chunked kernels
+MEMORY_BUDGET=2**27
+# params.E lays triples out in blocks by relation, one batched product for
+# all of them, unless blocks are so many (and G[r] so small) that gathering
+# G[r] for each triple is cheaper: when triples*floats(G[r]) < blocks*GATHER_FLOATS
+GATHER_FLOATS=2**13
 
 # --- functions ! --- #
 def clean_word(word):
@@ -52,72 +86,1527 @@ def clean_word(word):
     word4 = word3.rstrip(' ')
     return word4
 
+def chunk_length(floats_per_item, itemsize=8):
+    """
+    How many items we can process at once without blowing MEMORY_BUDGET,
+    if each item needs floats_per_item temporary floats.
+    """
+    return max(1, int(MEMORY_BUDGET/(itemsize*floats_per_item)))
+
+def all_triples(W, R):
+    """
+    Every (s, r, t) combination, in s, r, t (row-major) order.
+    """
+    return np.indices((W, R, W)).reshape(3, -1).T
+
+def logsumexp(x):
+    """
+    log(sum(exp(x))), without overflowing.
+    """
+    x_max = np.max(x)
+    if np.isinf(x_max):
+        return x_max
+    # (summing in double precision, whatever x is)
+    return x_max + np.log(np.sum(np.exp(x - x_max), dtype=np.float64))
+
+def sigmoid(x):
+    """
+    1/(1 + exp(-x)), without overflowing.
+    """
+    return 0.5*(1 + np.tanh(0.5*np.asarray(x)))
+
+def pairwise_distances(A, B):
+    """
+    Matrix of euclidean distances between the rows of A and the rows of B.
+    (via |a - b|^2 = |a|^2 + |b|^2 - 2a.b, so agrees with a direct norm up to rounding)
+    """
+    sq_dist = np.dot(A, -2*B.T)
+    sq_dist += np.einsum('...i,...i', A, A).reshape(-1, 1)
+    sq_dist += np.einsum('...i,...i', B, B).reshape(1, -1)
+    return np.sqrt(np.maximum(sq_dist, 0))
+
+def pairwise_cosines(A, B):
+    """
+    Matrix of cosines of angles between the rows of A and the rows of B.
+    """
+    A_len = np.linalg.norm(A, axis=1).reshape(-1, 1)
+    B_len = np.linalg.norm(B, axis=1).reshape(1, -1)
+    cosines = np.dot(A, B.T)/(A_len*B_len)
+    return np.clip(cosines, -1, 1)
+
+def sample_categorical(logits, rng=np.random):
+    """
+    One draw per row of logits, with P(i) proportional to exp(logits[m, i]).
+    Batched inverse-CDF: rows are shifted by their max first, so nothing
+    overflows, and we never normalise.
+    """
+    logits = np.atleast_2d(logits)
+    if use_kernels():
+        u = rng.random_sample(len(logits))
+        draws = np.empty(shape=len(logits), dtype=np.int)
+        get_kernel(categorical_kernel)(logits, u, draws)
+        return draws
+    shifted = logits - np.max(logits, axis=1).reshape(-1, 1)
+    cdf = np.cumsum(np.exp(shifted), axis=1, dtype=np.float64)
+    u = rng.random_sample(len(cdf))*cdf[:, -1]
+    draws = np.sum(cdf <= u.reshape(-1, 1), axis=1)
+    return np.minimum(draws, cdf.shape[1] - 1)
+
+def shared_array(shape, dtype=np.float):
+    """
+    An array of zeros in shared memory: processes forked after this see
+    (and write to) the same buffer.
+    """
+    dtype = np.dtype(dtype)
+    n_bytes = max(int(np.prod(shape))*dtype.itemsize, 1)
+    raw = multiprocessing.RawArray('b', n_bytes)
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def group_indices(indices):
+    """
+    Groups equal values of an integer array.
+    Returns the (stable) sorting order, the unique values, and the group
+    boundaries: group g is order[bounds[g]:bounds[g+1]] and has value uniq[g].
+    """
+    indices = np.asarray(indices)
+    order = np.argsort(indices, kind='mergesort')
+    if len(indices) == 0:
+        return order, indices[:0], np.zeros(1, dtype=np.int)
+    sorted_indices = indices[order]
+    starts = np.flatnonzero(np.r_[True, sorted_indices[1:] != sorted_indices[:-1]])
+    uniq = sorted_indices[starts]
+    bounds = np.r_[starts, len(indices)]
+    return order, uniq, bounds
+
+def index_blocks(indices, n_values):
+    """
+    Lays the rows of an integer array (values in [0, n_values)) out in
+    blocks, one per distinct value: returns the values, and each row's
+    block and place within it (rows keep their order within a block).
+    A few values get one comparison pass each, which is cheaper than sorting.
+    """
+    indices = np.asarray(indices)
+    counts = np.bincount(indices, minlength=n_values)
+    values = np.flatnonzero(counts)
+    if 0 < len(values) < np.log2(max(len(indices), 2)):
+        order = np.concatenate([np.flatnonzero(indices == value) for value in values])
+    else:
+        order = np.argsort(indices, kind='mergesort')
+    counts = counts[values]
+    block = np.empty(shape=len(indices), dtype=np.int)
+    place = np.empty(shape=len(indices), dtype=np.int)
+    block[order] = np.repeat(np.arange(len(values)), counts)
+    place[order] = np.arange(len(indices)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return values, block, place
+
+def is_block_column(r, X):
+    """
+    Is r a column of relations, one per block of rows of X (see dense_relations)?
+    """
+    return np.ndim(r) == 2 and np.shape(r)[1] == 1 and np.ndim(X) == 3
+
+def index_groups(indices, n_values):
+    """
+    (value, rows) for each value (in [0, n_values)) of an integer array,
+    rows being where it occurs. A few values get one comparison pass each,
+    which is cheaper than sorting; many are grouped by group_indices.
+    """
+    indices = np.asarray(indices)
+    values = np.flatnonzero(np.bincount(indices, minlength=n_values))
+    if len(values) < np.log2(max(len(indices), 2)):
+        return [(value, np.flatnonzero(indices == value)) for value in values]
+    order, uniq, bounds = group_indices(indices)
+    return [(value, order[bounds[g]:bounds[g+1]]) for (g, value) in enumerate(uniq)]
+
+def group_sum(indices, values):
+    """
+    Sums the rows of 'values' (first axis) which share an index.
+    Returns the unique indices and the corresponding sums.
+    """
+    if use_kernels() and len(indices) > 0:
+        uniq = np.unique(indices)
+        sums = np.zeros(shape=(len(uniq),)+values.shape[1:], dtype=values.dtype)
+        get_kernel(scatter_rows_kernel)(np.searchsorted(uniq, indices),
+                                        values.reshape(len(values), -1),
+                                        sums.reshape(len(uniq), -1))
+        return uniq, sums
+    order, uniq, bounds = group_indices(indices)
+    if len(uniq) == 0:
+        return uniq, values[:0]
+    sums = np.add.reduceat(values[order], bounds[:-1], axis=0)
+    return uniq, sums
+
+def scatter_add(target, indices, values):
+    """
+    target[indices] += values, except repeated indices accumulate
+    (plain fancy-index assignment would keep only the last one).
+    Works in place on target, and returns it.
+    """
+    uniq, sums = group_sum(indices, values)
+    target[uniq] += sums
+    return target
+
 # --- data stream --- #
+def open_text(path):
+    """
+    Opens a (possibly gzipped) text data file.
+    """
+    if '.gz' in path:
+        return gzip.open(path, 'r')
+    else:
+        return open(path, 'r')
+
+def is_binary_triples(path):
+    """
+    Does this file start with TRIPLES_MAGIC?
+    """
+    fi = open(path, 'rb')
+    magic = fi.read(len(TRIPLES_MAGIC))
+    fi.close()
+    return magic == TRIPLES_MAGIC
+
+def read_binary_header(path):
+    """
+    Returns W, R, N from the header of a binary triple file.
+    """
+    fi = open(path, 'rb')
+    fi.seek(len(TRIPLES_MAGIC))
+    W, R, N = np.fromfile(fi, dtype='<i8', count=3)
+    fi.close()
+    return int(W), int(R), int(N)
+
+def write_binary_header(fo, W, R, N):
+    """
+    Writes the header of a binary triple file at the start of fo.
+    """
+    fo.seek(0)
+    fo.write(TRIPLES_MAGIC)
+    fo.write(np.array([W, R, N], dtype='<i8').tostring())
+
+def read_text_header(fi):
+    """
+    W, R from the first line of an open text data file.
+    """
+    values = map(int, fi.readline().split())
+    if not len(values) == 2:
+        sys.exit('ERROR: data file incorrectly formatted.')
+    W, R = values
+    return W, R
+
+def text_blocks(fi, block_bytes=INGEST_BLOCK_BYTES):
+    """
+    Reads an open text file in blocks of about block_bytes, each ending
+    on a line boundary (so each one can be parsed by itself).
+    """
+    leftover = ''
+    while True:
+        block = fi.read(block_bytes)
+        if len(block) == 0:
+            break
+        block = leftover + block
+        cut = block.rfind('\n') + 1
+        leftover = block[cut:]
+        if cut > 0:
+            yield block[:cut]
+    if len(leftover.strip()) > 0:
+        yield leftover
+
+def parse_triples(block):
+    """
+    Text block of 's r t' lines -> int32 (n, 3) array.
+    """
+    triples = np.fromstring(block, dtype=np.int32, sep=' ')
+    if not len(triples) % 3 == 0:
+        sys.exit('ERROR: data file incorrectly formatted.')
+    return triples.reshape(-1, 3)
+
+def parsed_blocks(path, workers=None, block_bytes=INGEST_BLOCK_BYTES):
+    """
+    Yields the triples of a text data file as int32 arrays, one per block,
+    in file order. Big files are parsed by a pool of worker processes;
+    we only read ahead a couple of blocks per worker, to bound memory.
+    """
+    fi = open_text(path)
+    read_text_header(fi)
+    blocks = text_blocks(fi, block_bytes)
+    if workers is None:
+        if os.path.getsize(path) > INGEST_PARALLEL_BYTES:
+            workers = multiprocessing.cpu_count()
+        else:
+            workers = 1
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        while True:
+            wave = [block for (i, block) in zip(xrange(2*workers), blocks)]
+            if len(wave) == 0:
+                break
+            for triples in pool.map(parse_triples, wave):
+                yield triples
+        pool.close()
+        pool.join()
+    else:
+        for block in blocks:
+            yield parse_triples(block)
+    fi.close()
+
+def read_triples(path, workers=None, block_bytes=INGEST_BLOCK_BYTES):
+    """
+    Reads a whole text data file into a compact int32 (N, 3) array.
+    We don't know N up front, so the array grows (by 25%) and finally
+    shrinks in place; big reallocations are remapped rather than copied,
+    so peak memory stays close to the final size.
+    """
+    triples = np.empty(shape=(0, 3), dtype=np.int32)
+    N = 0
+    for block in parsed_blocks(path, workers, block_bytes):
+        if N + len(block) > len(triples):
+            capacity = max(int(1.25*len(triples)), N + len(block))
+            triples.resize((capacity, 3), refcheck=False)
+        triples[N:N+len(block)] = block
+        N += len(block)
+    triples.resize((N, 3), refcheck=False)
+    return triples
+
+def convert_triples(in_path, out_path, block_bytes=INGEST_BLOCK_BYTES):
+    """
+    One-off conversion from the text format (header 'W R', then 's r t'
+    lines, possibly gzipped) to the binary format read by data_stream.
+    Streams through the file, so memory use doesn't depend on its size.
+    Returns N.
+    """
+    fi = open_text(in_path)
+    W, R = read_text_header(fi)
+    fi.close()
+    fo = open(out_path, 'wb')
+    write_binary_header(fo, W, R, 0)
+    N = 0
+    for block in parsed_blocks(in_path, block_bytes=block_bytes):
+        fo.write(block.astype('<i4').tostring())
+        N += len(block)
+    # now we know N
+    write_binary_header(fo, W, R, N)
+    fo.close()
+    return N
+
+def write_triples(path, triples, W, R, binary=False):
+    """
+    Writes an (N, 3) triple array as a data file: the text format
+    (gzipped if path ends in .gz), or the binary one.
+    """
+    triples = np.asarray(triples)
+    if binary:
+        fo = open(path, 'wb')
+        write_binary_header(fo, W, R, len(triples))
+        fo.write(triples.astype('<i4').tostring())
+        fo.close()
+        return
+    if '.gz' in path:
+        fo = gzip.open(path, 'w')
+    else:
+        fo = open(path, 'w')
+    fo.write(str(W)+' '+str(R)+'\n')
+    step = chunk_length(3)
+    for lo in xrange(0, len(triples), step):
+        fo.write(''.join('%d %d %d\n' % tuple(triple) for triple in triples[lo:lo+step]))
+    fo.close()
+
+def synthetic_triples(W, R, N, d=10, etype=None, seed=None):
+    """
+    N triples from a random (planted) model, e.g. for benchmarks.
+    Heads and relations have Zipf-like frequencies, as in real knowledge
+    graphs; tails are drawn from the planted model given them,
+    p(t | s, r) proportional to exp(-E(s, r, t)), so there's structure
+    to learn. Returns the int32 (N, 3) array and the planted (C, G, V).
+    """
+    rng = np.random.RandomState(seed)
+    # (scaled so that dot product energies are of order 1)
+    scale = d**(-0.25)
+    C = rng.normal(scale=scale, size=(W, d+1))
+    V = rng.normal(scale=scale, size=(W, d+1))
+    C[:, -1] = 1
+    V[:, -1] = 1
+    G = np.zeros(shape=(R, d+1, d+1))
+    G[:] = np.eye(d+1)
+    G[:, :-1, :] += rng.normal(scale=1.0/np.sqrt(d), size=(R, d, d+1))
+    planted = params((C, G, V), etype=etype)
+    def zipf(n):
+        p = 1.0/np.arange(1, n+1)
+        return rng.permutation(p/np.sum(p))
+    triples = np.zeros(shape=(N, 3), dtype=np.int32)
+    triples[:, 0] = rng.choice(W, N, p=zipf(W))
+    triples[:, 1] = rng.choice(R, N, p=zipf(R))
+    step = chunk_length(2*W)
+    for lo in xrange(0, N, step):
+        chunk = triples[lo:lo+step]
+        energy = planted.E_axes(chunk, 'V')
+        chunk[:, 2] = sample_categorical(-energy, rng)
+    return triples, (C, G, V)
+
+class shuffled_triples(object):
+    """
+    A triple array (e.g. a memmap) seen through a random permutation,
+    without copying it: rows are gathered a chunk at a time as you iterate.
+    Indexing (ints, slices, index arrays) goes through the permutation too.
+    (without a seed, the permutation comes from np.random)
+    """
+    def __init__(self, data, seed=None):
+        self.data = data
+        self.seed = seed
+        if seed is None:
+            self.order = np.random.permutation(len(data))
+        else:
+            self.order = np.random.RandomState(seed).permutation(len(data))
+    def __len__(self):
+        return len(self.data)
+    def __getitem__(self, index):
+        return self.data[self.order[index]]
+    def __array__(self, dtype=None):
+        return np.asarray(self.data[self.order], dtype=dtype)
+    def __iter__(self):
+        step = chunk_length(3, itemsize=self.data.itemsize)
+        for lo in xrange(0, len(self.data), step):
+            for example in self.data[self.order[lo:lo+step]]:
+                yield example
+
 class data_stream(object):
     """
     Class for data stream.
     (can use this as a generator)
+    Reads either the text format, or the binary format made by
+    convert_triples (which is memory-mapped, not read).
     """
     def __init__(self, path):
         self.path = path
+        # (the file isn't touched until it's needed: see is_binary)
+        self.binary = None
+    def is_binary(self):
+        """
+        Is it the binary format? (looked at once, then remembered)
+        """
+        if self.binary is None:
+            self.binary = is_binary_triples(self.path)
+        return self.binary
     def __iter__(self):
         """
         Just spits out lines from the file.
         """
-        if '.gz' in self.path:
-            fi = gzip.open(self.path,'r')
-        else:
-            fi = open(self.path,'r')
-        header = fi.readline()
-        while True:
-            line = fi.readline()
-            if len(line) == 0: # EOF
-                break
-            else:
-                example = map(int, line.split())
+        for chunk in self.chunks():
+            for example in chunk:
                 yield example
+    def chunks(self):
+        """
+        Spits out the file as a sequence of int (n, 3) arrays.
+        """
+        if self.is_binary():
+            triples = self.memmap()
+            step = chunk_length(3, itemsize=triples.itemsize)
+            for lo in xrange(0, len(triples), step):
+                yield triples[lo:lo+step]
+        else:
+            for block in parsed_blocks(self.path, workers=1):
+                yield block
     def get_vocab_sizes(self):
         """
         The first line of the data file should contain W, R.
         """
-        if '.gz' in self.path:
-            fi = gzip.open(self.path,'r')
-        else:
-            fi = open(self.path,'r')
-        header = fi.readline()
+        if self.is_binary():
+            W, R, N = read_binary_header(self.path)
+            return W, R
+        fi = open_text(self.path)
+        W, R = read_text_header(fi)
         fi.close()
-        values = map(int, header.split())
-        if len(values) == 2:
-            W, R = values
-        else:
-            sys.exit('ERROR: data file incorrectly formatted.')
         return W, R
-    def acquire_all(self):
+    def memmap(self):
+        """
+        The (N, 3) triples of a binary file, memory-mapped read-only.
+        (so it costs nothing up front, and processes share the page cache)
+        """
+        W, R, N = read_binary_header(self.path)
+        if N == 0:
+            return np.zeros(shape=(0, 3), dtype=np.int32)
+        return np.memmap(self.path, dtype='<i4', mode='r',
+                         offset=TRIPLES_HEADER, shape=(N, 3))
+    def acquire_all(self, seed=None):
         """
         Just suck it all in!
+        (binary files are mapped rather than read; shuffling then goes
+        through shuffled_triples instead of moving the data)
+        With a seed, the shuffle can be repeated (e.g. to resume training);
+        without one it comes from np.random.
         """
-        traindata = [[0, 0, 0]]
-        if '.gz' in self.path:
-            fi = gzip.open(self.path, 'r')
-        else:
-            fi = open(self.path, 'r')
-        header = fi.readline()
-        for line in fi:
-            s, r, t = map(int, line.split())
-            traindata.append([s, r, t])
-        traindata = np.array(traindata[1:])
+        if self.is_binary():
+            traindata = self.memmap()
+            if SHUFFLE:
+                traindata = shuffled_triples(traindata, seed)
+            return traindata
+        traindata = read_triples(self.path)
         if SHUFFLE:
-            np.random.shuffle(traindata)
-        return np.array(traindata[1:])
+            if seed is None:
+                np.random.shuffle(traindata)
+            else:
+                np.random.RandomState(seed).shuffle(traindata)
+        return traindata
+
+# --- held-out triples --- #
+def pack_triples(triples, W, R):
+    """
+    Packs (s, r, t) into one int64 key, (s*R + r)*W + t.
+    """
+    triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+    return (triples[:, 0]*R + triples[:, 1])*W + triples[:, 2]
+
+def unpack_keys(keys, W, R):
+    """
+    Inverse of pack_triples.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    triples = np.empty(shape=(len(keys), 3), dtype=np.int64)
+    triples[:, 2] = keys % W
+    triples[:, 1] = (keys // W) % R
+    triples[:, 0] = keys // (W*R)
+    return triples
+
+def in_sorted(keys, sorted_keys):
+    """
+    Vectorised membership: is each of keys in the sorted array sorted_keys?
+    """
+    keys = np.asarray(keys)
+    if len(sorted_keys) == 0:
+        return np.zeros(shape=keys.shape, dtype=np.bool)
+    position = np.searchsorted(sorted_keys, keys)
+    position = np.minimum(position, len(sorted_keys) - 1)
+    return sorted_keys[position] == keys
+
+def triple_chunks(data, lo=0, hi=None):
+    """
+    Yields the triples of data as int (n, 3) arrays, a chunk at a time.
+    data can be an array, a memmap, a shuffled_triples or a data_stream
+    (lo and hi pick out rows [lo, hi) of data)
+    """
+    if isinstance(data, data_stream):
+        # no random access, so skip (and stop) as we go
+        position = 0
+        for chunk in data.chunks():
+            chunk_lo = max(lo - position, 0)
+            chunk_hi = len(chunk) if hi is None else min(hi - position, len(chunk))
+            position += len(chunk)
+            if chunk_hi > chunk_lo:
+                yield chunk[chunk_lo:chunk_hi]
+            if not hi is None and position >= hi:
+                break
+    else:
+        if hi is None:
+            hi = len(data)
+        step = chunk_length(3, itemsize=4)
+        for chunk_lo in xrange(lo, hi, step):
+            yield np.asarray(data[chunk_lo:min(chunk_lo+step, hi)])
+
+def holdout_split(data, size, W, R, method='random', seed=None):
+    """
+    Chooses 'size' distinct triples of data to hold out for validation.
+    method is 'random' (uniform over the rows of data) or 'stratified'
+    (each relation gets its share of the held-out set, by frequency).
+    Returns the held-out triples and their sorted keys (see pack_triples),
+    which is what you check training chunks against.
+    data must support len and index arrays (see triple_chunks); for a
+    data_stream we choose among the first few chunks.
+    Without a seed we take one from np.random, so np.random.seed still
+    repeats the split.
+    """
+    if seed is None:
+        seed = np.random.randint(2**31 - 1)
+    rng = np.random.RandomState(seed)
+    if isinstance(data, data_stream):
+        head = []
+        for chunk in data.chunks():
+            head.append(np.asarray(chunk))
+            if sum(map(len, head)) >= 10*size:
+                break
+        data = np.concatenate(head) if len(head) > 0 else np.zeros(shape=(0, 3), dtype=np.int32)
+    N = len(data)
+    size = min(size, N)
+    if method == 'stratified':
+        counts = np.zeros(shape=R, dtype=np.int64)
+        for chunk in triple_chunks(data):
+            counts += np.bincount(chunk[:, 1], minlength=R)
+        share = size*counts/float(N)
+        quota = np.floor(share).astype(np.int64)
+        # the leftovers go to the biggest remainders
+        leftover = int(size - np.sum(quota))
+        quota[np.argsort(quota - share)[:leftover]] += 1
+    elif method == 'random':
+        quota = None
+    else:
+        sys.exit('ERROR: unknown holdout method '+str(method))
+    keys = np.zeros(shape=0, dtype=np.int64)
+    for attempt in xrange(100):
+        if len(keys) >= size:
+            break
+        rows = rng.randint(0, N, size=2*(size - len(keys)) + 16)
+        candidates = pack_triples(data[rows], W, R)
+        # new keys only, in the order drawn
+        candidates = candidates[~np.in1d(candidates, keys)]
+        uniq, first = np.unique(candidates, return_index=True)
+        candidates = candidates[np.sort(first)]
+        if not quota is None:
+            relas = (candidates // W) % R
+            taken = np.bincount((keys // W) % R, minlength=R)
+            order, uniq_relas, bounds = group_indices(relas)
+            rank = np.empty(shape=len(candidates), dtype=np.int64)
+            rank[order] = np.arange(len(candidates)) - np.repeat(bounds[:-1], np.diff(bounds))
+            candidates = candidates[rank < (quota - taken)[relas]]
+        keys = np.concatenate([keys, candidates[:size - len(keys)]])
+    if len(keys) < size:
+        print 'WARNING: could only find', len(keys), 'distinct triples to hold out.'
+    vali_set = unpack_keys(keys, W, R)
+    return vali_set, np.sort(keys)
+
+class known_triples(object):
+    """
+    Index of the (distinct) triples in some data, for "is (s, r, t) known?"
+    and "which t are known for (s, r)?" (or s for (r, t)), many at a time.
+    Keeps the sorted keys (see pack_triples), and two CSR-style layouts:
+    the known t of each (s, r) pair present, and the known s of each (r, t).
+    That's 16 bytes per triple, plus 12 per distinct pair.
+    """
+    def __init__(self, data, W, R):
+        self.W = W
+        self.R = R
+        keys = [pack_triples(chunk, W, R) for chunk in triple_chunks(data)]
+        if len(keys) == 0:
+            keys = [np.zeros(shape=0, dtype=np.int64)]
+        self.keys = np.unique(np.concatenate(keys))
+        del keys
+        triples = unpack_keys(self.keys, W, R)
+        # (s, r) -> t: the keys are already in (s, r, t) order
+        self.sr_keys, self.sr_offsets = self.groups(triples[:, 0]*R + triples[:, 1])
+        self.tails = triples[:, 2].astype(np.int32)
+        # (r, t) -> s
+        rt = triples[:, 1]*W + triples[:, 2]
+        order = np.argsort(rt*W + triples[:, 0])
+        self.rt_keys, self.rt_offsets = self.groups(rt[order])
+        self.heads = triples[order, 0].astype(np.int32)
+
+    def groups(self, sorted_keys):
+        """
+        The distinct values of sorted_keys, and where each one's run starts
+        (with len(sorted_keys) on the end).
+        """
+        uniq, starts = np.unique(sorted_keys, return_index=True)
+        return uniq, np.append(starts, len(sorted_keys)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, triples):
+        """
+        Boolean array: is each of triples known?
+        """
+        return in_sorted(pack_triples(triples, self.W, self.R), self.keys)
+
+    def completions(self, triples, switch):
+        """
+        All the known completions of each triple along one axis: its known
+        t given (s, r) for switch 'V', known s given (r, t) for switch 'C'.
+        Returns (rows, entries): triples[rows[i]] is completed by entries[i].
+        """
+        triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+        if switch == 'V':
+            queries = triples[:, 0]*self.R + triples[:, 1]
+            group_keys, offsets, values = self.sr_keys, self.sr_offsets, self.tails
+        elif switch == 'C':
+            queries = triples[:, 1]*self.W + triples[:, 2]
+            group_keys, offsets, values = self.rt_keys, self.rt_offsets, self.heads
+        else: sys.exit('ERROR: completions are over C or V.')
+        found = in_sorted(queries, group_keys)
+        group = np.searchsorted(group_keys, queries)[found]
+        starts = offsets[group]
+        counts = offsets[group + 1] - starts
+        rows = np.repeat(np.flatnonzero(found), counts)
+        # (concatenated ranges [starts, starts + counts))
+        within = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        entries = values[np.repeat(starts, counts) + within]
+        return rows, entries
+
+# --- link prediction --- #
+def top_k_rows(energy, k):
+    """
+    Column indices of the k smallest entries of each row of energy, and
+    those entries, both (M, k), smallest first.
+    (argpartition, so only the k get sorted)
+    """
+    energy = np.atleast_2d(energy)
+    k = min(k, energy.shape[1])
+    if k < energy.shape[1]:
+        best = np.argpartition(energy, k-1, axis=1)[:, :k]
+    else:
+        best = np.tile(np.arange(k), (len(energy), 1))
+    best_energy = energy[np.arange(len(energy)).reshape(-1, 1), best]
+    order = np.argsort(best_energy, axis=1)
+    best = best[np.arange(len(best)).reshape(-1, 1), order]
+    return best, np.sort(best_energy, axis=1)
+
+class mips_index(object):
+    """
+    Approximate maximum inner product search over the rows of X.
+    Rows get an extra coordinate, sqrt(max|x|^2 - |x|^2), so that they all
+    have the same length and the largest inner product with q (padded with
+    0) is the nearest row (Bachrach et al., RecSys 2014). The padded rows
+    are clustered by k-means into n_clusters (default sqrt(len(X))) lists;
+    a query scores only the rows in the n_probe lists with the nearest
+    centroids, so costs O((n_clusters + n_probe*len(X)/n_clusters)*d), not
+    O(len(X)*d). Built from X as it is: rebuild it after X changes.
+    """
+    def __init__(self, X, n_clusters=None, n_iterations=10, seed=None):
+        self.X = np.array(X)
+        N = len(self.X)
+        if n_clusters is None:
+            n_clusters = int(np.ceil(np.sqrt(N)))
+        n_clusters = min(n_clusters, N)
+        sq_lens = np.sum(self.X*self.X, axis=1)
+        padded = np.hstack([self.X, np.sqrt(np.max(sq_lens) - sq_lens).reshape(-1, 1)])
+        rng = np.random.RandomState(seed)
+        centroids = padded[rng.choice(N, n_clusters, replace=False)]
+        for iteration in xrange(n_iterations):
+            assignment = self.nearest(padded, centroids)
+            counts = np.bincount(assignment, minlength=n_clusters)
+            sums = np.zeros(shape=centroids.shape)
+            scatter_add(sums, assignment, padded)
+            # (empty clusters stay put)
+            full = counts > 0
+            centroids[full] = sums[full]/counts[full].reshape(-1, 1)
+        assignment = self.nearest(padded, centroids)
+        # the lists, CSR-style
+        self.members = np.argsort(assignment, kind='mergesort')
+        self.bounds = np.searchsorted(assignment[self.members], np.arange(n_clusters + 1))
+        # (a padded query's nearest centroids maximise q.c - |c|^2/2)
+        self.centroids = centroids[:, :-1]
+        self.centroid_bias = -0.5*np.sum(centroids*centroids, axis=1)
+
+    def nearest(self, points, centroids):
+        """
+        Index of the nearest centroid to each point (in chunks).
+        """
+        assignment = np.empty(shape=len(points), dtype=np.int)
+        step = chunk_length(len(centroids))
+        for start in xrange(0, len(points), step):
+            distances = pairwise_distances(points[start:start+step], centroids)
+            assignment[start:start+step] = np.argmin(distances, axis=1)
+        return assignment
+
+    def query(self, Q, k, n_probe=None):
+        """
+        Approximately the k rows of X with the largest inner products with
+        each row of Q: (indices, inner products), both (M, k), largest first.
+        (a query with fewer than k candidates is padded with -1 and -inf)
+        """
+        Q = np.atleast_2d(Q)
+        n_clusters = len(self.centroids)
+        if n_probe is None:
+            n_probe = max(1, int(np.ceil(np.sqrt(n_clusters))))
+        n_probe = min(n_probe, n_clusters)
+        probes = top_k_rows(-(np.dot(Q, self.centroids.T) + self.centroid_bias), n_probe)[0]
+        indices = np.zeros(shape=(len(Q), k), dtype=np.int) - 1
+        scores = np.zeros(shape=(len(Q), k)) - np.inf
+        for (m, probe) in enumerate(probes):
+            candidates = np.concatenate([self.members[self.bounds[c]:self.bounds[c+1]] for c in probe])
+            best, best_energy = top_k_rows(-np.dot(self.X[candidates], Q[m]), k)
+            indices[m, :best.shape[1]] = candidates[best[0]]
+            scores[m, :best.shape[1]] = -best_energy[0]
+        return indices, scores
+
+def triple_ranks(parameters, triples, switch, workers=None, known=None):
+    """
+    The rank of each triple's own entry (its t for switch 'V', its s for
+    'C') among all completions of the rest of it, by energy: 1 is best,
+    and ties go in the triple's favour.
+    With known (a known_triples), other known completions don't count
+    against it (the 'filtered' ranks).
+    Chunks of triples are scored (as in params.top_k) by a pool of
+    'workers' threads (default: one per CPU).
+    """
+    triples = np.asarray(triples)
+    axis = 'CGV'.index(switch)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    step = min(chunk_length(parameters.axes_floats(switch)*workers),
+               int(np.ceil(float(len(triples))/workers)))
+    step = max(step, 1)
+    if not parameters.cache is None:
+        # (so the threads don't all try)
+        parameters.refresh_cache()
+    def chunk_ranks(start):
+        # (numpy's error settings are per thread)
+        np.seterr(all='raise')
+        np.seterr(under='warn')
+        chunk = triples[start:start+step]
+        energy = parameters.E_axes(chunk, switch)
+        own = energy[np.arange(len(chunk)), chunk[:, axis]]
+        if not known is None:
+            energy[known.completions(chunk, switch)] = np.inf
+        return 1 + np.sum(energy < own.reshape(-1, 1), axis=1)
+    starts = range(0, len(triples), step)
+    if workers == 1 or len(starts) == 1:
+        ranks = map(chunk_ranks, starts)
+    else:
+        pool = ThreadPool(workers)
+        ranks = pool.map(chunk_ranks, starts)
+        pool.close()
+    return np.concatenate(ranks)
+
+def ranking_metrics(ranks):
+    """
+    Mean rank, mean reciprocal rank and hits@{1, 3, 10} (as fractions),
+    in RANK_COLUMNS order.
+    """
+    ranks = np.asarray(ranks, dtype=np.float)
+    return [np.mean(ranks), np.mean(1/ranks),
+            np.mean(ranks <= 1), np.mean(ranks <= 3), np.mean(ranks <= 10)]
+
+def evaluate_ranking(parameters, triples, workers=None, known=None):
+    """
+    Link prediction quality on test triples: each is ranked against all
+    W heads (s) and all W tails (t), and ranking_metrics summarises the
+    lot. Returns a dict keyed by RANK_COLUMNS.
+    (filtered, if given the known triples: see triple_ranks)
+    """
+    ranks = np.concatenate([triple_ranks(parameters, triples, 'C', workers, known),
+                            triple_ranks(parameters, triples, 'V', workers, known)])
+    return dict(zip(RANK_COLUMNS, ranking_metrics(ranks)))
+
+# --- noise --- #
+class alias_table(object):
+    """
+    Walker's alias method (set up as in Vose, 1991): O(n) to build, then
+    each draw from the distribution over n outcomes (proportional to
+    'weights') is O(1), one random integer and one uniform.
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float)
+        n = len(weights)
+        probs = weights/np.sum(weights)
+        with np.errstate(divide='ignore'):
+            self.log_probs = np.log(probs)
+        scaled = probs*n
+        self.prob = np.ones(shape=n)
+        self.alias = np.arange(n)
+        small = list(np.flatnonzero(scaled < 1))
+        large = list(np.flatnonzero(scaled >= 1))
+        while len(small) > 0 and len(large) > 0:
+            lo = small.pop()
+            hi = large.pop()
+            self.prob[lo] = scaled[lo]
+            self.alias[lo] = hi
+            scaled[hi] = scaled[hi] + scaled[lo] - 1
+            if scaled[hi] < 1:
+                small.append(hi)
+            else:
+                large.append(hi)
+
+    def draw(self, M, rng=np.random):
+        outcome = rng.randint(0, len(self.prob), M)
+        keep = rng.random_sample(M) < self.prob[outcome]
+        return np.where(keep, outcome, self.alias[outcome])
+
+class noise_distribution(object):
+    """
+    Where NOISE samples come from, fitted to the triples in data:
+        'uniform'   s, r and t uniform (as sample_noise always did)
+        'unigram'   s, r and t independent, each by its frequency (in that
+                    position) to the power 'power' (0.75 as in word2vec)
+        'relation'  r by its frequency, then s and t independently by their
+                    frequencies within relation r ('power' is ignored)
+    Draws are O(1) each: alias tables for the unigrams, and for 'relation',
+    a draw from the block of relation r's heads (or tails).
+    log_prob gives log q(s, r, t), for NCE.
+    """
+    def __init__(self, data, W, R, kind='unigram', power=1.0):
+        self.W = W
+        self.R = R
+        self.kind = kind
+        if kind == 'uniform':
+            return
+        elif not kind in ['unigram', 'relation']:
+            sys.exit('ERROR: unknown noise distribution '+str(kind))
+        counts_C = np.zeros(shape=W, dtype=np.int64)
+        counts_R = np.zeros(shape=R, dtype=np.int64)
+        counts_V = np.zeros(shape=W, dtype=np.int64)
+        heads, tails = [], []
+        for chunk in triple_chunks(data):
+            counts_C += np.bincount(chunk[:, 0], minlength=W)
+            counts_R += np.bincount(chunk[:, 1], minlength=R)
+            counts_V += np.bincount(chunk[:, 2], minlength=W)
+            if kind == 'relation':
+                relas = chunk[:, 1].astype(np.int64)
+                heads.append(relas*W + chunk[:, 0])
+                tails.append(relas*W + chunk[:, 2])
+        if kind == 'unigram':
+            self.tables = [alias_table(counts**power) for counts in [counts_C, counts_R, counts_V]]
+        else:
+            self.relas = alias_table(counts_R)
+            # relation r's (r*W + s) keys, sorted, in [offsets[r], offsets[r+1])
+            self.heads = np.sort(np.concatenate(heads))
+            self.tails = np.sort(np.concatenate(tails))
+            self.offsets = np.append(0, np.cumsum(counts_R))
+
+    def sample(self, M, rng=np.random):
+        """
+        M triples, as an (M, 3) array.
+        """
+        if self.kind == 'uniform':
+            return np.array(zip(rng.randint(0, self.W, M),
+                                rng.randint(0, self.R, M),
+                                rng.randint(0, self.W, M)))
+        elif self.kind == 'unigram':
+            return np.array([table.draw(M, rng) for table in self.tables]).T
+        relas = self.relas.draw(M, rng)
+        lo = self.offsets[relas]
+        size = self.offsets[relas + 1] - lo
+        heads = self.heads[lo + (rng.random_sample(M)*size).astype(np.int64)] % self.W
+        tails = self.tails[lo + (rng.random_sample(M)*size).astype(np.int64)] % self.W
+        return np.array([heads, relas, tails]).T
+
+    def log_prob(self, triples):
+        """
+        log q(s, r, t) for each of triples (-inf for impossible ones).
+        """
+        triples = np.asarray(triples)
+        if self.kind == 'uniform':
+            return np.zeros(shape=len(triples)) - np.log(self.W*self.R*self.W)
+        elif self.kind == 'unigram':
+            return sum(table.log_probs[triples[:, i]] for (i, table) in enumerate(self.tables))
+        relas = triples[:, 1].astype(np.int64)
+        size = (self.offsets[relas + 1] - self.offsets[relas]).astype(np.float)
+        log_prob = self.relas.log_probs[relas]
+        for (keys, column) in [(self.heads, 0), (self.tails, 2)]:
+            key = relas*self.W + triples[:, column]
+            count = np.searchsorted(keys, key, 'right') - np.searchsorted(keys, key, 'left')
+            with np.errstate(divide='ignore'):
+                log_prob = log_prob + np.log(count/np.maximum(size, 1))
+        return log_prob
+
+# --- compiled kernels --- #
+def kernel(function):
+    """
+    Compiles function with numba, if there is numba (see KERNELS).
+    Kernels are plain loops over arrays, so they also run (slowly) as
+    python, which is how check_kernels tests them without numba.
+    """
+    if numba is None:
+        return function
+    return numba.njit(nogil=True)(function)
+
+def use_kernels():
+    """
+    Whether to take the kernel paths (see KERNELS).
+    """
+    if KERNELS is None:
+        return not numba is None
+    if KERNELS == 'numba' and numba is None:
+        sys.exit('ERROR: KERNELS = numba, but numba is not installed.')
+    return KERNELS in ['numba', 'python']
+
+def get_kernel(function):
+    """
+    The kernel to call: compiled, or as python if KERNELS = 'python'.
+    """
+    if KERNELS == 'python':
+        return getattr(function, 'py_func', function)
+    return function
+
+@kernel
+def categorical_draw(logits, u):
+    """
+    One draw with P(i) proportional to exp(logits[i]), by inverse CDF at
+    u (uniform on [0, 1)), as in sample_categorical.
+    """
+    n = logits.shape[0]
+    top = logits[0]
+    for i in range(1, n):
+        if logits[i] > top:
+            top = logits[i]
+    weights = np.empty(n)
+    total = 0.0
+    for i in range(n):
+        weights[i] = np.exp(logits[i] - top)
+        total += weights[i]
+    target = u*total
+    cumulative = 0.0
+    for i in range(n):
+        cumulative += weights[i]
+        if cumulative > target:
+            return i
+    return n - 1
+
+@kernel
+def categorical_kernel(logits, u, draws):
+    """
+    categorical_draw for each row of logits.
+    """
+    for m in range(logits.shape[0]):
+        draws[m] = categorical_draw(logits[m], u[m])
+
+@kernel
+def scatter_rows_kernel(positions, values, out):
+    """
+    out[positions[i]] += values[i], for 2d values and out.
+    """
+    for i in range(positions.shape[0]):
+        p = positions[i]
+        for j in range(values.shape[1]):
+            out[p, j] += values[i, j]
+
+@kernel
+def dot_sweep_kernel(chains, orders, u, beta, C, G, V):
+    """
+    One Gibbs iteration of every chain (see params.sample_chains), for
+    the dot energy and dense G: chain m resamples axis orders[m, step]
+    at each step, with uniform u[m, step].
+    """
+    W = C.shape[0]
+    R = G.shape[0]
+    n = C.shape[1]
+    logits_W = np.empty(W)
+    logits_R = np.empty(R)
+    vec = np.empty(n)
+    for m in range(chains.shape[0]):
+        for step in range(3):
+            s = chains[m, 0]
+            r = chains[m, 1]
+            t = chains[m, 2]
+            axis = orders[m, step]
+            if axis == 1:
+                for q in range(R):
+                    energy = 0.0
+                    for i in range(n):
+                        GC = 0.0
+                        for j in range(n):
+                            GC += G[q, i, j]*C[s, j]
+                        energy -= V[t, i]*GC
+                    logits_R[q] = -beta*energy
+                chains[m, 1] = categorical_draw(logits_R, u[m, step])
+                continue
+            if axis == 0:
+                # V[t]G[r], against every C
+                for j in range(n):
+                    total = 0.0
+                    for i in range(n):
+                        total += V[t, i]*G[r, i, j]
+                    vec[j] = total
+                X = C
+            else:
+                # G[r]C[s], against every V
+                for i in range(n):
+                    total = 0.0
+                    for j in range(n):
+                        total += G[r, i, j]*C[s, j]
+                    vec[i] = total
+                X = V
+            for w in range(W):
+                energy = 0.0
+                for i in range(n):
+                    energy -= X[w, i]*vec[i]
+                logits_W[w] = -beta*energy
+            chains[m, axis] = categorical_draw(logits_W, u[m, step])
+
+@kernel
+def euclidean_sweep_kernel(chains, orders, u, beta, C, G, V):
+    """
+    dot_sweep_kernel, for the euclidean energy.
+    """
+    W = C.shape[0]
+    R = G.shape[0]
+    n = C.shape[1]
+    logits_W = np.empty(W)
+    logits_R = np.empty(R)
+    GV = np.empty(n)
+    for m in range(chains.shape[0]):
+        for step in range(3):
+            s = chains[m, 0]
+            r = chains[m, 1]
+            t = chains[m, 2]
+            axis = orders[m, step]
+            if axis == 0:
+                # G[r]V[t], against every C
+                for i in range(n):
+                    total = 0.0
+                    for j in range(n):
+                        total += G[r, i, j]*V[t, j]
+                    GV[i] = total
+                for w in range(W):
+                    distance = 0.0
+                    for i in range(n):
+                        distance += (GV[i] - C[w, i])**2
+                    logits_W[w] = beta*np.sqrt(distance)
+                chains[m, 0] = categorical_draw(logits_W, u[m, step])
+            elif axis == 1:
+                for q in range(R):
+                    distance = 0.0
+                    for i in range(n):
+                        total = 0.0
+                        for j in range(n):
+                            total += G[q, i, j]*V[t, j]
+                        distance += (total - C[s, i])**2
+                    logits_R[q] = beta*np.sqrt(distance)
+                chains[m, 1] = categorical_draw(logits_R, u[m, step])
+            else:
+                for w in range(W):
+                    distance = 0.0
+                    for i in range(n):
+                        total = 0.0
+                        for j in range(n):
+                            total += G[r, i, j]*V[w, j]
+                        distance += (total - C[s, i])**2
+                    logits_W[w] = beta*np.sqrt(distance)
+                chains[m, 2] = categorical_draw(logits_W, u[m, step])
+
+def check_kernels(parameters, n_chains=100, K=3, seed=0):
+    """
+    Parity check of the kernels against the numpy reference: the same
+    Gibbs chains (parameters.sample_chains), categorical draws and group
+    sums from both, from the same random state. Returns the fraction of
+    chain entries and of draws which differ (rounding can flip the odd
+    draw, then the chain goes its own way) and the largest group sum
+    difference. Without numba, the kernels run as python.
+    """
+    global KERNELS
+    saved = KERNELS
+    backends = ['numpy', 'python' if numba is None else 'numba']
+    rng = np.random.RandomState(seed)
+    seeds = np.array(zip(rng.randint(0, parameters.W, n_chains),
+                         rng.randint(0, parameters.R, n_chains),
+                         rng.randint(0, parameters.W, n_chains)))
+    logits = rng.normal(scale=3, size=(n_chains, parameters.W))
+    rows = rng.randint(0, parameters.W, 10*n_chains)
+    values = rng.normal(size=(len(rows), parameters.d+1))
+    out = []
+    try:
+        for KERNELS in backends:
+            chains = parameters.sample_chains(seeds, K, rng=np.random.RandomState(seed))
+            draws = sample_categorical(logits, np.random.RandomState(seed))
+            uniq, sums = group_sum(rows, values)
+            out.append((chains, draws, sums))
+    finally:
+        KERNELS = saved
+    (chains, draws, sums), (k_chains, k_draws, k_sums) = out
+    return {'chains':np.mean(chains != k_chains),
+            'draws':np.mean(draws != k_draws),
+            'group_sum':np.max(abs(sums - k_sums))}
+
+# --- relation operators --- #
+class dense_relations(object):
+    """
+    Each relation is a full (d+1, d+1) matrix acting on [x, 1] vectors, so
+    G is (R, d+1, d+1). Other parameterisations store G differently, but
+    answer the same questions, so params never touches G directly.
+    Throughout, r is a relation (the same for every row of X), an array
+    of relations aligned with the rows of X (or broadcasting against its
+    leading axes: a column of g relations for X of (g, m, d+1) applies one
+    to each block of m rows), or None (every relation, giving
+    (R, len(X), d+1)).
+    (rank is only for relation types which have one)
+    """
+    name = 'dense'
+    def __init__(self, d, rank=None):
+        self.d = d
+        self.rank = rank
+    def shape(self, R):
+        return (R, self.d+1, self.d+1)
+    def left(self, G, r, X):
+        """
+        G[r]x for each row x of X.
+        """
+        if r is None:
+            return np.einsum('rij,nj->rni', G, X)
+        if np.ndim(r) == 0:
+            return np.dot(X, G[r].T)
+        if is_block_column(r, X):
+            # (one matrix product per block, rather than gathering G[r] per row)
+            return np.matmul(X, G[r[:, 0]].transpose(0, 2, 1))
+        return np.einsum('...ij,...j', G[r], X)
+    def right(self, G, r, X):
+        """
+        xG[r] for each row x of X.
+        """
+        if r is None:
+            return np.dot(X, G).transpose(1, 0, 2)
+        if np.ndim(r) == 0:
+            return np.dot(X, G[r])
+        if is_block_column(r, X):
+            return np.matmul(X, G[r[:, 0]])
+        return np.einsum('...i,...ij', X, G[r])
+    def outer(self, G, r, A, B):
+        """
+        Gradient of a.G[r]b with respect to relation r's parameters, for
+        aligned rows a, b of A, B (and r).
+        """
+        return np.einsum('...i,...j', A, B)
+    def outer_sum(self, G, r, A, B):
+        """
+        The sum over rows of outer, all under the one relation r.
+        """
+        return np.dot(A.T, B)
+    def constrain(self, dG):
+        """
+        Zeroes the parts of a gradient which must never move.
+        """
+        # (the last row keeps the homogeneous coordinate)
+        dG[..., -1, :] = 0
+        return dG
+    def to_dense(self, G):
+        return G
+    def from_dense(self, G):
+        return G
+
+class translation_relations(dense_relations):
+    """
+    Each relation is the identity plus a translation column, so G holds
+    just the (R, d) offsets: G[r]x = [x + G[r]x_1, x_1] (x_1 the final,
+    homogeneous, coordinate). Everything is O(d) per triple.
+    """
+    name = 'translation'
+    def shape(self, R):
+        return (R, self.d)
+    def left(self, G, r, X):
+        if r is None:
+            out = np.empty(shape=(len(G),)+X.shape, dtype=np.result_type(G, X))
+            out[...] = X
+            out[..., :-1] += G.reshape(len(G), 1, -1)*X[:, -1:]
+            return out
+        out = np.array(X, dtype=np.result_type(G, X))
+        out[..., :-1] += G[r]*X[..., -1:]
+        return out
+    def right(self, G, r, X):
+        if r is None:
+            out = np.empty(shape=(len(G),)+X.shape, dtype=np.result_type(G, X))
+            out[...] = X
+            out[..., -1] += np.dot(G, X[:, :-1].T)
+            return out
+        out = np.array(X, dtype=np.result_type(G, X))
+        out[..., -1] += np.sum(X[..., :-1]*G[r], axis=-1)
+        return out
+    def outer(self, G, r, A, B):
+        return A[..., :-1]*B[..., -1:]
+    def outer_sum(self, G, r, A, B):
+        return np.dot(B[:, -1], A[:, :-1])
+    def constrain(self, dG):
+        return dG
+    def to_dense(self, G):
+        dense = np.zeros(shape=(len(G), self.d+1, self.d+1), dtype=G.dtype)
+        dense[:] = np.eye(self.d+1)
+        dense[:, :-1, -1] = G
+        return dense
+    def from_dense(self, G):
+        if not np.allclose(G[:, :, :-1], np.eye(self.d+1)[:, :-1]):
+            print 'WARNING: G is not all translations; keeping only the final column.'
+        return np.array(G[:, :-1, -1])
+
+class lowrank_relations(dense_relations):
+    """
+    Each relation is diag(D) + U Q^T, with U, Q (d+1, k): G is
+    (R, 1+2k, d+1), holding D, then the k columns of U, then those of Q.
+    The last entry of D stays 1 and the last row of U stays 0, so G[r]
+    keeps its homogeneous last row (Q's last row gives the translation).
+    Everything is O(dk) per triple.
+    NOTE: U and Q only get gradient through each other, so columns which
+    start (or are converted) at zero stay there: initialise them randomly.
+    """
+    name = 'lowrank'
+    def __init__(self, d, rank=None):
+        if rank is None or not 0 < 2*rank < d:
+            sys.exit('ERROR: lowrank relations need 0 < 2*rank < d (else use dense).')
+        self.d = d
+        self.rank = rank
+    def shape(self, R):
+        return (R, 1+2*self.rank, self.d+1)
+    def unpack(self, G, r):
+        """
+        D, U^T, Q^T of relation(s) r (all relations if r is None).
+        """
+        k = self.rank
+        if r is None:
+            G_r = G
+        else:
+            G_r = G[r]
+        return G_r[..., 0, :], G_r[..., 1:1+k, :], G_r[..., 1+k:, :]
+    def product(self, D, A, B, r, X):
+        """
+        x diag(D) + (x A^T) B for each row x of X, with A, B as from unpack.
+        """
+        if r is None:
+            AX = np.matmul(X, A.transpose(0, 2, 1))
+            return D.reshape(len(D), 1, -1)*X + np.matmul(AX, B)
+        if np.ndim(r) == 0:
+            return D*X + np.dot(np.dot(X, A.T), B)
+        AX = np.einsum('...kj,...j', A, X)
+        return D*X + np.einsum('...k,...ki', AX, B)
+    def left(self, G, r, X):
+        D, Ut, Qt = self.unpack(G, r)
+        return self.product(D, Qt, Ut, r, X)
+    def right(self, G, r, X):
+        D, Ut, Qt = self.unpack(G, r)
+        return self.product(D, Ut, Qt, r, X)
+    def outer(self, G, r, A, B):
+        k = self.rank
+        D, Ut, Qt = self.unpack(G, r)
+        out = np.empty(shape=(len(A),)+G.shape[1:], dtype=np.result_type(G, A, B))
+        out[:, 0] = A*B
+        out[:, 1:1+k] = np.einsum('...kj,...j', Qt, B).reshape(len(B), k, 1)*A.reshape(len(A), 1, -1)
+        out[:, 1+k:] = np.einsum('...kj,...j', Ut, A).reshape(len(A), k, 1)*B.reshape(len(B), 1, -1)
+        return out
+    def outer_sum(self, G, r, A, B):
+        k = self.rank
+        D, Ut, Qt = self.unpack(G, r)
+        out = np.empty(shape=G.shape[1:], dtype=np.result_type(G, A, B))
+        out[0] = np.sum(A*B, axis=0)
+        out[1:1+k] = np.dot(np.dot(B, Qt.T).T, A)
+        out[1+k:] = np.dot(np.dot(A, Ut.T).T, B)
+        return out
+    def constrain(self, dG):
+        dG[..., :1+self.rank, -1] = 0
+        return dG
+    def to_dense(self, G):
+        D, Ut, Qt = self.unpack(G, None)
+        dense = np.matmul(Ut.transpose(0, 2, 1), Qt)
+        diagonal = np.arange(self.d+1)
+        dense[:, diagonal, diagonal] += D
+        return dense
+    def from_dense(self, G, max_iterations=500, tolerance=1e-9):
+        """
+        Splits each G[r] into a diagonal and a rank-k part, alternating
+        between the best rank-k approximation (by SVD) of G[r] - diag(D)
+        and the diagonal of what that leaves, until the dropped singular
+        values are (relatively) below tolerance, or stop shrinking.
+        (so G which came from to_dense comes back, up to tolerance)
+        """
+        k = self.rank
+        diagonal = np.arange(self.d+1)
+        D = G[:, diagonal, diagonal]
+        scale = np.linalg.norm(G)
+        last_lost = np.inf
+        for iteration in xrange(max_iterations):
+            rest = np.array(G)
+            rest[:, diagonal, diagonal] -= D
+            U, S, Qt = np.linalg.svd(rest)
+            root_S = np.sqrt(S[:, :k]).reshape(len(G), 1, k)
+            U_k = root_S*U[:, :, :k]
+            Qt_k = root_S.transpose(0, 2, 1)*Qt[:, :k]
+            lost = np.sqrt(np.sum(S[:, k:]**2))
+            if lost <= tolerance*scale or lost > 0.99*last_lost:
+                break
+            last_lost = lost
+            D = G[:, diagonal, diagonal] - np.einsum('rik,rki->ri', U_k, Qt_k)
+        if lost > tolerance*scale:
+            print 'WARNING: G is not diagonal + rank', k, '(lost', lost, 'of', scale, ')'
+        compact = np.empty(shape=(len(G),)+self.shape(1)[1:], dtype=G.dtype)
+        compact[:, 0] = D
+        compact[:, 1:1+k] = U_k.transpose(0, 2, 1)
+        compact[:, 1+k:] = Qt_k
+        compact[:, 1:1+k, -1] = 0
+        return compact
+
+# relation parameterisations, by name (see params)
+RELATIONS = {'dense':dense_relations,
+             'translation':translation_relations,
+             'lowrank':lowrank_relations}
+
+# --- energy models --- #
+class energy_model(object):
+    """
+    How C[s] and the relation-transformed V[t] (see params.project) make
+    an energy. A model gives the kernels
+        project     rows of V transformed by relation(s) r (see dense_relations)
+        pair        energies of aligned rows of C_sub and GV (any leading shape)
+        cross       energies of every row of C_blk against every row of GV
+        grad        per-triple gradients (see params.grad_E)
+        grad_cross  weighted sums of gradients over a slab (see params.grad_E_slab)
+    and the axis and slab loops here work from those, for any model.
+    Models are picked per params (see ENERGIES), so they can differ
+    within one process.
+    """
+    name = None
+    # a compiled Gibbs iteration (see dot_sweep_kernel), if there is one
+    sweep_kernel = None
+    def project(self, rels, G, r, V_sub):
+        return rels.left(G, r, V_sub)
+    def axes(self, parameters, triples, switch):
+        """
+        See params.E_axes.
+        """
+        s, r, t = triples[:, 0], triples[:, 1], triples[:, 2]
+        if switch == 'C':
+            # return over all S
+            energy = self.cross(parameters.C, parameters.project(r, t)).T
+        elif switch == 'G':
+            # return over all R
+            GV = parameters.project(None, t)
+            energy = self.pair(parameters.C[s].reshape(len(triples), 1, -1), GV)
+        elif switch == 'V':
+            # return over all T
+            # (G[r] has to hit every V, so do one relation at a time)
+            energy = np.empty(shape=(len(triples), parameters.W), dtype=np.float)
+            for (rela, which) in index_groups(r, parameters.R):
+                energy[which] = self.cross(parameters.C[s[which]], parameters.project(rela))
+        else:
+            print 'ERROR: Cannot parse switch.'
+            sys.exit()
+        return energy
+    def slab(self, parameters, r, s_lo, s_hi):
+        """
+        See params.E_slab.
+        """
+        return self.cross(parameters.C[s_lo:s_hi], parameters.project(r))
+
+class dot_energy(energy_model):
+    """
+    E = -V[t].(G[r]C[s]), i.e. -C[s].(V[t]G[r]): project gives V[t]G[r].
+    """
+    name = 'dot'
+    sweep_kernel = staticmethod(dot_sweep_kernel)
+    def project(self, rels, G, r, V_sub):
+        return rels.right(G, r, V_sub)
+    def pair(self, C_sub, GV):
+        return -np.einsum('...i,...i->...', GV, C_sub)
+    def cross(self, C_blk, GV):
+        return -np.dot(C_blk, GV.T)
+    def axes(self, parameters, triples, switch):
+        s, r, t = triples[:, 0], triples[:, 1], triples[:, 2]
+        if switch == 'C':
+            return -np.dot(parameters.project(r, t), parameters.C.T)
+        if switch == 'V':
+            # (cheaper to transform the few C than look up all of V)
+            GC = parameters.relations.left(parameters.G, r, parameters.C[s])
+            return -np.dot(GC, parameters.V.T)
+        return energy_model.axes(self, parameters, triples, switch)
+    def slab(self, parameters, r, s_lo, s_hi):
+        if parameters.cache is None:
+            GC = parameters.relations.left(parameters.G, r, parameters.C[s_lo:s_hi])
+            return -np.dot(GC, parameters.V.T)
+        return energy_model.slab(self, parameters, r, s_lo, s_hi)
+    def grad(self, parameters, r, C_sub, V_sub):
+        rels, G = parameters.relations, parameters.G
+        dE_C = -rels.right(G, r, V_sub)
+        dE_G = -rels.outer(G, r, V_sub, C_sub)
+        dE_V = -rels.left(G, r, C_sub)
+        return dE_C, dE_G, dE_V
+    def grad_cross(self, parameters, r, C_blk, weights, energy):
+        rels, G, V = parameters.relations, parameters.G, parameters.V
+        wC = np.dot(weights.T, C_blk)
+        dE_C = -rels.right(G, r, np.dot(weights, V))
+        dE_G = -rels.outer_sum(G, r, V, wC)
+        dE_V = -rels.left(G, r, wC)
+        return dE_C, dE_G, dE_V
+
+class euclidean_energy(energy_model):
+    """
+    E = -|G[r]V[t] - C[s]|.
+    """
+    name = 'euclidean'
+    sweep_kernel = staticmethod(euclidean_sweep_kernel)
+    def pair(self, C_sub, GV):
+        return -np.linalg.norm(GV - C_sub, axis=-1)
+    def cross(self, C_blk, GV):
+        # (uses |a - b|^2 = |a|^2 + |b|^2 - 2a.b, so this agrees with pair
+        # up to rounding)
+        return -pairwise_distances(C_blk, GV)
+    def grad(self, parameters, r, C_sub, V_sub):
+        rels, G = parameters.relations, parameters.G
+        GV_C = rels.left(G, r, V_sub) - C_sub
+        lens = np.linalg.norm(GV_C, axis=1).reshape(-1, 1)
+        GV_Cl = GV_C/lens
+        dE_C = 1*GV_C/lens
+        dE_G = -rels.outer(G, r, GV_Cl, V_sub)
+        dE_V = -rels.right(G, r, GV_Cl)
+        return dE_C, dE_G, dE_V
+    def grad_cross(self, parameters, r, C_blk, weights, energy):
+        rels, G, V = parameters.relations, parameters.G, parameters.V
+        GV = parameters.project(r)
+        Q = weights/(-energy)
+        Q_s = np.sum(Q, axis=1).reshape(-1, 1)
+        Q_t = np.sum(Q, axis=0).reshape(-1, 1)
+        QC = np.dot(Q.T, C_blk)
+        dE_C = np.dot(Q, GV) - Q_s*C_blk
+        dE_G = -rels.outer_sum(G, r, Q_t*GV - QC, V)
+        dE_V = -rels.right(G, r, Q_t*GV - QC)
+        return dE_C, dE_G, dE_V
+
+class angular_energy(energy_model):
+    """
+    E = 1 - angle(G[r]V[t], C[s])/pi.
+    """
+    name = 'angular'
+    # (in the gradient, cosines stay this far from +-1, where 1/sin blows up)
+    clip = 1e-7
+    def pair(self, C_sub, GV):
+        GVC = np.sum(GV*C_sub, axis=-1)
+        GV_len = np.linalg.norm(GV, axis=-1)
+        C_len = np.linalg.norm(C_sub, axis=-1)
+        return 1 - (1/pi)*np.arccos(np.clip(GVC/(GV_len*C_len), -1, 1))
+    def cross(self, C_blk, GV):
+        return 1 - (1/pi)*np.arccos(pairwise_cosines(C_blk, GV))
+    def grad(self, parameters, r, C_sub, V_sub):
+        # E = 1 - arccos(cos)/pi, so dE = dcos/(pi*sin)
+        rels, G = parameters.relations, parameters.G
+        GV = rels.left(G, r, V_sub)
+        GV_len = np.linalg.norm(GV, axis=1).reshape(-1, 1)
+        C_len = np.linalg.norm(C_sub, axis=1).reshape(-1, 1)
+        cosines = np.clip(np.sum(GV*C_sub, axis=1).reshape(-1, 1)/(GV_len*C_len),
+                          -1 + self.clip, 1 - self.clip)
+        dEdcos = 1/(pi*np.sqrt(1 - cosines*cosines))
+        dE_C = dEdcos*(GV/(GV_len*C_len) - cosines*C_sub/(C_len*C_len))
+        # (the gradient with respect to GV, which G[r] and V[t] share)
+        dE_GV = dEdcos*(C_sub/(GV_len*C_len) - cosines*GV/(GV_len*GV_len))
+        dE_G = rels.outer(G, r, dE_GV, V_sub)
+        dE_V = rels.right(G, r, dE_GV)
+        return dE_C, dE_G, dE_V
+    def grad_cross(self, parameters, r, C_blk, weights, energy):
+        rels, G, V = parameters.relations, parameters.G, parameters.V
+        GV = parameters.project(r)
+        GV_len = np.linalg.norm(GV, axis=1)
+        C_len = np.linalg.norm(C_blk, axis=1)
+        cosines = np.dot(C_blk, GV.T)/np.outer(C_len, GV_len)
+        cosines = np.clip(cosines, -1 + self.clip, 1 - self.clip)
+        dEdcos = weights/(pi*np.sqrt(1 - cosines*cosines))
+        A = dEdcos/np.outer(C_len, GV_len)
+        B = dEdcos*cosines
+        B_s = (np.sum(B, axis=1)/(C_len*C_len)).reshape(-1, 1)
+        B_t = (np.sum(B, axis=0)/(GV_len*GV_len)).reshape(-1, 1)
+        AC = np.dot(A.T, C_blk)
+        dE_C = np.dot(A, GV) - B_s*C_blk
+        dE_G = rels.outer_sum(G, r, AC - B_t*GV, V)
+        dE_V = rels.right(G, r, AC - B_t*GV)
+        return dE_C, dE_G, dE_V
+
+# energy models, by name (see params; ETYPE is the default)
+ENERGIES = {'dot':dot_energy,
+            'euclidean':euclidean_energy,
+            'angular':angular_energy}
 
 # --- parameters object --- #
 class params(object):
     """
     Parameter object.
     Contains C, G, V and velocities for all.
+    dtype is for C, G, V (and so the gradients); state_dtype for the
+    velocities/accelerations (default: dtype). Both default to what the
+    initial parameters have, e.g. dtype=np.float32 with state_dtype=np.float64
+    keeps the Adam state in double precision.
+    relations picks how G is stored (see RELATIONS): e.g. 'translation'
+    keeps only an offset per relation, 'lowrank' a diagonal plus factors
+    of rank relation_rank. Dense initial G is converted to it (and back,
+    to save as .txt/.npy). Default: whatever the initial parameters are.
+    etype picks the energy model (see ENERGIES). Default: the checkpoint's,
+    else ETYPE. So do fix_words, fix_relas, trans_rela and cache (default:
+    the checkpoint's, else False).
     """
     def __init__(self, initial_parameters, vocab=None,
-                 fix_words=False, fix_relas=False, trans_rela=False):
+                 fix_words=None, fix_relas=None, trans_rela=None, cache=None,
+                 dtype=None, state_dtype=None, relations=None, relation_rank=None,
+                 etype=None):
+        if not relations is None and not relations in RELATIONS:
+            sys.exit('ERROR: unknown relations '+str(relations))
+        if not etype is None and not etype in ENERGIES:
+            sys.exit('ERROR: unknown etype '+str(etype))
         if type(initial_parameters) == str:
             # assume a PATH has been given
             params_path = initial_parameters
@@ -127,13 +1616,17 @@ class params(object):
             C, G, V = initial_parameters
             if C.shape != V.shape:
                 raise ValueError
-            if G.shape[1] != C.shape[1]:
-                raise ValueError
-            if G.shape[2] != C.shape[1]:
-                raise ValueError
             self.W = C.shape[0]
             self.R = G.shape[0]
             self.d = C.shape[1] - 1
+            # (G is dense, or already as relations wants it)
+            self.relations = dense_relations(self.d)
+            if not relations is None:
+                wanted = RELATIONS[relations](self.d, relation_rank)
+                if G.shape == wanted.shape(self.R):
+                    self.relations = wanted
+            if G.shape != self.relations.shape(self.R):
+                raise ValueError
             # vocab
             try:
                 self.words = vocab['words']
@@ -143,39 +1636,173 @@ class params(object):
                 self.words = map(str, range(self.W))
                 self.relas = map(str, range(self.R))
             # weights
-            self.C = deepcopy(C)
-            self.G = deepcopy(G)
-            self.V = deepcopy(V)
+            self.C = np.array(C, dtype=dtype)
+            self.G = np.array(G, dtype=dtype)
+            self.V = np.array(V, dtype=dtype)
+        if not relations is None and not relations == self.relations.name:
+            if hasattr(self, 'C_vel'):
+                sys.exit('ERROR: cannot change the relations of a checkpoint.')
+            G_dense = self.relations.to_dense(self.G)
+            self.relations = RELATIONS[relations](self.d, relation_rank)
+            self.G = self.relations.from_dense(G_dense)
+        if not etype is None:
+            self.energy = ENERGIES[etype]()
+        elif not hasattr(self, 'energy'):
+            self.energy = ENERGIES[ETYPE]()
+        if not dtype is None and not self.C.dtype == dtype:
+            for name in ['C', 'G', 'V']:
+                setattr(self, name, getattr(self, name).astype(dtype))
+        self.dtype = self.C.dtype
+        if hasattr(self, 'C_vel'):
+            if state_dtype is None:
+                state_dtype = self.C_vel.dtype
+            elif not self.C_vel.dtype == state_dtype:
+                for name in STATE_ARRAYS[3:9]:
+                    setattr(self, name, getattr(self, name).astype(state_dtype))
+        self.state_dtype = np.dtype(self.dtype if state_dtype is None else state_dtype)
+        if not hasattr(self, 'C_vel'):
+            # (checkpoints bring their own optimiser state)
+            self.reset_optimiser()
+        # (whatever the checkpoint was trained with, unless told otherwise)
+        flags = getattr(self, 'flags', dict())
+        if fix_words is None: fix_words = flags.get('fix_words', False)
+        if fix_relas is None: fix_relas = flags.get('fix_relas', False)
+        if trans_rela is None: trans_rela = flags.get('trans_rela', False)
+        if cache is None: cache = flags.get('cache', False)
+        # fix some parameters?
+        # (never update these)
+        self.fix_words = fix_words
+        self.fix_relas = fix_relas
+        # special type of relationship (translations only)
+        # (translation relations are nothing but that column anyway)
+        self.trans_rela = trans_rela and self.relations.name == 'dense'
+        # version counters for rows of G and V (bumped whenever they change)
+        self.G_version = np.zeros(shape=self.R, dtype=np.int64)
+        self.V_version = np.zeros(shape=self.W, dtype=np.int64)
+        self.cache = None
+        if cache:
+            self.enable_cache()
+
+    def enable_cache(self):
+        """
+        Keep every relation's transformed word vectors (see project) in an
+        (R, W, d+1) array, redoing only the relations and words whose
+        version counters have moved since.
+        """
+        n_bytes = self.dtype.itemsize*self.R*self.W*(self.d+1)
+        if n_bytes > MEMORY_BUDGET:
+            print 'WARNING: projection cache takes', n_bytes/2**20, 'MB.'
+        self.cache = np.empty(shape=(self.R, self.W, self.d+1), dtype=self.dtype)
+        self.cache_G_version = np.zeros(shape=self.R, dtype=np.int64) - 1
+        self.cache_V_version = np.zeros(shape=self.W, dtype=np.int64) - 1
+
+    def touch(self, which, rows=None):
+        """
+        Records that rows of G or V (which = 'G', 'V'; rows=None for all)
+        have changed, so the cache redoes them.
+        (call this after changing G or V by hand)
+        """
+        if which == 'C':
+            return
+        version = getattr(self, which+'_version')
+        if rows is None:
+            version += 1
+        else:
+            version[rows] += 1
+
+    def refresh_cache(self):
+        """
+        Brings the projection cache up to date with G and V.
+        """
+        # (read the versions first: changes made while we work show up next time)
+        G_version = np.array(self.G_version)
+        V_version = np.array(self.V_version)
+        relas = np.flatnonzero(self.cache_G_version != G_version)
+        words = np.flatnonzero(self.cache_V_version != V_version)
+        if len(relas) == self.R or len(words) == self.W:
+            self.cache[...] = self.project_rows(self.V)
+        else:
+            for r in relas:
+                self.cache[r] = self.project_rows(self.V, r)
+            if len(words) > 0:
+                self.cache[:, words] = self.project_rows(self.V[words])
+        self.cache_G_version[:] = G_version
+        self.cache_V_version[:] = V_version
+
+    def project_rows(self, V_sub, r=None):
+        """
+        The rows of V_sub transformed by G[r] (by every relation if r is None,
+        giving (R, len(V_sub), d+1)). See project.
+        """
+        return self.energy.project(self.relations, self.G, r, V_sub)
+
+    def project(self, r=None, t=None):
+        """
+        Relation-transformed word vectors: V[t]G[r] for 'dot' (the energy is
+        then -C[s].project), G[r]V[t] otherwise (compared with C[s]).
+            r a relation, t None:           all words, (W, d+1)
+            r, t aligned arrays of indices: (M, d+1)
+            r None, t an array:             all relations, (M, R, d+1)
+        Read from the cache, if there is one.
+        """
+        if not self.cache is None:
+            self.refresh_cache()
+            if t is None:
+                return self.cache[r]
+            if r is None:
+                return self.cache[:, t].transpose(1, 0, 2)
+            return self.cache[r, t]
+        if t is None:
+            return self.project_rows(self.V, r)
+        if r is None:
+            return self.project_rows(self.V[t]).transpose(1, 0, 2)
+        return self.project_rows(self.V[t], r)
+
+    def reset_optimiser(self):
+        """
+        Zero velocities/accelerations, as at the start of training.
+        """
         # velocities (this is m_t in Adam paper)
-        self.C_vel = np.zeros(shape=self.C.shape)
-        self.G_vel = np.zeros(shape=self.G.shape)
-        self.V_vel = np.zeros(shape=self.V.shape)
+        self.C_vel = np.zeros(shape=self.C.shape, dtype=self.state_dtype)
+        self.G_vel = np.zeros(shape=self.G.shape, dtype=self.state_dtype)
+        self.V_vel = np.zeros(shape=self.V.shape, dtype=self.state_dtype)
         # acceleration (this is v_t in Adam paper)
-        self.C_acc = np.zeros(shape=self.C.shape)
-        self.G_acc = np.zeros(shape=self.G.shape)
-        self.V_acc = np.zeros(shape=self.V.shape)
-        # fix some parameters?
-        # (never update these)
-        self.fix_words = fix_words
-        self.fix_relas = fix_relas
-        # special type of relationship (translations only)
-        self.trans_rela = trans_rela
+        self.C_acc = np.zeros(shape=self.C.shape, dtype=self.state_dtype)
+        self.G_acc = np.zeros(shape=self.G.shape, dtype=self.state_dtype)
+        self.V_acc = np.zeros(shape=self.V.shape, dtype=self.state_dtype)
+        # for sparse updates: how many updates so far (an array, so it can
+        # live in shared memory), and when each row last had its optimiser
+        # state brought up to date
+        self.clock = np.zeros(shape=1, dtype=np.int64)
+        self.C_last = np.zeros(shape=self.W, dtype=np.int64)
+        self.G_last = np.zeros(shape=self.R, dtype=np.int64)
+        self.V_last = np.zeros(shape=self.W, dtype=np.int64)
 
     def update(self, grad_parameters, alpha, mu, nu=None):
         """
         Updates parameters.
         Note: assumes alpha, mu, nu are pre-updated.
         """
+        # in case this follows some sparse updates
+        self.catch_up(alpha, mu, nu)
+        self.clock[0] += 1
+        self.C_last[:] = self.clock[0]
+        self.G_last[:] = self.clock[0]
+        self.V_last[:] = self.clock[0]
         # unwrap
         gradC, gradG, gradV = grad_parameters
         alphaC, alphaG, alphaV = alpha
         muC, muG, muV = mu
         # update velocities
+        # (in place, so shared-memory parameters stay shared)
         if not self.fix_words:
-            self.C_vel = muC*self.C_vel + (1-muC)*gradC
-            self.V_vel = muV*self.V_vel + (1-muV)*gradV
+            self.C_vel *= muC
+            self.C_vel += (1-muC)*gradC
+            self.V_vel *= muV
+            self.V_vel += (1-muV)*gradV
         if not self.fix_relas:
-            self.G_vel = muG*self.G_vel + (1-muG)*gradG
+            self.G_vel *= muG
+            self.G_vel += (1-muG)*gradG
         if ADAM:
             nuC, nuG, nuV = nu
             # accels (elementwise squaring)
@@ -184,10 +1811,13 @@ class params(object):
             gradsqV = gradV*gradV
             # update accelerations
             if not self.fix_words:
-                self.C_acc = nuC*self.C_acc + (1-nuC)*gradsqC
-                self.V_acc = nuV*self.V_acc + (1-nuV)*gradsqV
+                self.C_acc *= nuC
+                self.C_acc += (1-nuC)*gradsqC
+                self.V_acc *= nuV
+                self.V_acc += (1-nuV)*gradsqV
             if not self.fix_relas:
-                self.G_acc = nuG*self.G_acc + (1-nuG)*gradsqG
+                self.G_acc *= nuG
+                self.G_acc += (1-nuG)*gradsqG
             # get update-specific alphas
             alphaC_hat = alphaC*np.sqrt(1-nuC)/(1-muC)
             alphaG_hat = alphaG*np.sqrt(1-nuG)/(1-muG)
@@ -207,238 +1837,340 @@ class params(object):
         if not self.fix_words:
             self.C += alphaC_hat*deltaC
             self.V += alphaV_hat*deltaV
+            self.touch('V')
         if not self.fix_relas:
             if self.trans_rela:
                 # only update the final column of G
                 self.G[:, :, -1] += alphaG_hat*deltaG[:, :, -1]
             else:
                 self.G += alphaG_hat*deltaG
+            self.touch('G')
         if NORMALISE:
             # hax
             # the vectors are simple
             self.C[:, :-1] /= np.linalg.norm(self.C[:, :-1]).reshape(-1,1)
             self.V[:, :-1] /= np.linalg.norm(self.V[:, :-1]).reshape(-1,1)
             # the matrices are less simple
-            for r in xrange(self.R):
-                self.G[r, :-1, :] /= np.max(abs(self.G[r, :-1, :]))
+            if self.relations.name == 'dense':
+                for r in xrange(self.R):
+                    self.G[r, :-1, :] /= np.max(abs(self.G[r, :-1, :]))
+            self.touch('G')
+            self.touch('V')
+
+    def sparse_step(self, which, rows, grad, alpha, mu, nu=None):
+        """
+        One optimiser step for some rows of C, G or V (which = 'C', 'G', 'V'),
+        given their gradient rows. Rows are caught up first (see catch_up_rows).
+        """
+        X = getattr(self, which)
+        X_vel = getattr(self, which+'_vel')
+        X_acc = getattr(self, which+'_acc')
+        X_last = getattr(self, which+'_last')
+        self.catch_up_rows(which, rows, alpha, mu, nu)
+        vel = mu*X_vel[rows] + (1-mu)*grad
+        X_vel[rows] = vel
+        if ADAM:
+            acc = nu*X_acc[rows] + (1-nu)*grad*grad
+            X_acc[rows] = acc
+            alpha_hat = alpha*np.sqrt(1-nu)/(1-mu)
+            delta = vel/(np.sqrt(acc) + EPSILON)
+        else:
+            alpha_hat = alpha
+            delta = vel
+        if which == 'G' and self.trans_rela:
+            # only update the final column of G
+            X[rows, :, -1] += alpha_hat*delta[:, :, -1]
+        else:
+            X[rows] += alpha_hat*delta
+        X_last[rows] = self.clock[0] + 1
+        self.touch(which, rows)
+
+    def catch_up_rows(self, which, rows, alpha, mu, nu=None):
+        """
+        Rows which weren't in the last k updates had zero gradient there.
+        Applies those k steps in closed form: vel *= mu^k, acc *= nu^k, and
+        the parameter moves by the geometric sum of the decaying steps.
+        (for Adam this treats EPSILON as negligible next to sqrt(acc), and
+        uses the current alpha, mu, nu for all k steps)
+        """
+        X = getattr(self, which)
+        X_vel = getattr(self, which+'_vel')
+        X_acc = getattr(self, which+'_acc')
+        X_last = getattr(self, which+'_last')
+        k = self.clock[0] - X_last[rows]
+        rows = rows[k > 0]
+        k = k[k > 0].reshape((-1,) + (1,)*(X.ndim - 1))
+        if len(rows) == 0:
+            return
+        vel = X_vel[rows]
+        if ADAM:
+            acc = X_acc[rows]
+            alpha_hat = alpha*np.sqrt(1-nu)/(1-mu)
+            # sum_{j=1}^{k} mu^j vel/sqrt(nu^j acc)
+            q = mu/np.sqrt(nu)
+            delta = vel/(np.sqrt(acc) + EPSILON)*(q*(1 - q**k)/(1 - q))
+            X_acc[rows] = acc*nu**k
+        else:
+            alpha_hat = alpha
+            delta = vel*(mu*(1 - mu**k)/(1 - mu))
+        X_vel[rows] = vel*mu**k
+        if which == 'G' and self.trans_rela:
+            X[rows, :, -1] += alpha_hat*delta[:, :, -1]
+        else:
+            X[rows] += alpha_hat*delta
+        X_last[rows] = self.clock[0]
+        self.touch(which, rows)
+
+    def catch_up(self, alpha, mu, nu=None):
+        """
+        Brings every row up to date after sparse updates (see catch_up_rows).
+        Call before anything that needs exact parameters (saving, diagnostics).
+        """
+        if nu is None:
+            nu = [None]*3
+        if not self.fix_words:
+            self.catch_up_rows('C', np.arange(self.W), alpha[0], mu[0], nu[0])
+            self.catch_up_rows('V', np.arange(self.W), alpha[2], mu[2], nu[2])
+        if not self.fix_relas:
+            self.catch_up_rows('G', np.arange(self.R), alpha[1], mu[1], nu[1])
+
+    def update_sparse(self, grad_rows, alpha, mu, nu=None):
+        """
+        Like update, but only touches the rows which have gradients.
+        grad_rows is ((rows_C, gradC), (rows_G, gradG), (rows_V, gradV)),
+        as from batch_gradient(..., sparse=True). All other rows are left
+        stale, to be caught up when they are next updated (or by catch_up).
+        So an update costs O(batch) rather than O(W*d + R*d^2).
+        """
+        if NORMALISE:
+            sys.exit('ERROR: NORMALISE needs dense updates.')
+        if nu is None:
+            nu = [None]*3
+        (rows_C, gradC), (rows_G, gradG), (rows_V, gradV) = grad_rows
+        if not self.fix_words:
+            self.sparse_step('C', rows_C, gradC, alpha[0], mu[0], nu[0])
+            self.sparse_step('V', rows_V, gradV, alpha[2], mu[2], nu[2])
+        if not self.fix_relas:
+            self.sparse_step('G', rows_G, gradG, alpha[1], mu[1], nu[1])
+        self.clock[0] += 1
 
     def grad_E(self, locations):
         """
         Gradients of the energy, evaluated at a list of triples.
-        NOTE: this clearly depends on the choice of energy.
+        (see energy_model.grad)
         Returns tensors whose first index corresponds to the input triple list.
         """
-        C_sub = self.C[locations[:, 0]]
-        G_sub = self.G[locations[:, 1]]
-        V_sub = self.V[locations[:, 2]]
-        if ETYPE == 'dot':
-            # TODO: make this efficient
-            dE_C = -np.einsum('...i,...ij', V_sub, G_sub)
-            dE_G = -np.einsum('...i,...j', V_sub, C_sub)
-            dE_V = -np.einsum('...ij,...j', G_sub, C_sub)
-        elif ETYPE == 'euclidean':
-            # TODO: make efficient, probably
-            # NOTE: applying G to V, not C
-            GV_C = np.einsum('...ij,...j', G_sub, V_sub) - C_sub
-            lens = np.linalg.norm(GV_C, axis=1).reshape(-1, 1)
-            GV_Cl = GV_C/lens
-            dE_C = 1*GV_C/lens
-            dE_G = -np.einsum('...i,...j', GV_Cl, V_sub)
-            dE_V = -np.einsum('...i,...ij', GV_Cl, G_sub)
-        elif ETYPE =='angular':
-            # TODO: make efficient, probably
-            # also test
-            # NOTE: applying G to V, not C
-            GV = np.einsum('...ij,...j', G_sub, V_sub)
-            GVC = np.einsum('...i,...i', GV, C_sub).reshape(-1, 1)
-            GV_len = np.linalg.norm(GV, axis=1).reshape(-1, 1)
-            C_len = np.linalg.norm(C_sub, axis=1).reshape(-1, 1)
-            # yolo
-            print GV_len.shape
-            print C_len.shape
-            print GVC.shape
-            print (C_sub/C_len).shape
-            print GV.shape
-            print 'csubshape'
-            print C_sub.shape
-            print C_len.shape
-            dE_C = 1/(GV_len*C_len*C_len)*(C_len*GV - GVC*(C_sub/C_len))
-            prefactor = 1/(GV_len*GV_len*C_len)
-            print prefactor.shape
-            dE_G = prefactor*(GV_len*np.einsum('...i,...j', C_sub, V_sub) - (GVC/GV_len)*(np.einsum('...i,...j', GV, V_sub)))
-            dE_V = prefactor*(GV_len*np.einsum('...ij,...i', G_sub, C_sub) - (GVC/GV_len)*(np.einsum('...i,...ij', GV, G_sub)))
-        else:
-            sys.exit('ERROR: Not implemented')
-        return dE_C, dE_G, dE_V
+        return self.energy.grad(self, locations[:, 1], self.C[locations[:, 0]],
+                                self.V[locations[:, 2]])
 
     def E_axis(self, triple, switch):
         """
         Returns energies over an axis (S, R, T) given two of the triple.
         """
-        s, r, t = triple
-        if switch == 'C':
-            # return over all S
-            #GC = np.dot(self.C, self.G[r].T)
-            #energy = -np.dot(GC, self.V[t])
-            # note: above version is significantly slower than the below
-            if ETYPE == 'dot':
-                VG = np.dot(self.V[t], self.G[r])
-                energy = -np.dot(self.C, VG)
-            elif ETYPE == 'euclidean':
-                GV = np.dot(self.G[r, :, :], self.V[t, :])
-                energy = -np.linalg.norm(GV - self.C, axis=1)
-            elif ETYPE == 'angular':
-                GV = np.dot(self.G[r, :, :], self.V[t, :])
-                GVC = np.einsum('...j,...ij', GV, self.C)
-                GV_len = np.linalg.norm(GV)
-                C_len = np.linalg.norm(self.C, axis=1)
-                energy = 1 - (1/pi)*np.arccos(GVC/(GV_len*C_len))
-            else: sys.exit('ERROR: Not implemented')
-        elif switch == 'G':
-            # return over all R
-            if ETYPE == 'dot':
-                VG = np.dot(self.V[t], self.G)
-                energy = -np.dot(VG, self.C[s])
-            elif ETYPE == 'euclidean':
-                GV = np.dot(self.G[:, :, :], self.V[t, :])
-                energy = -np.linalg.norm(GV - self.C[s, :], axis=1)
-            elif ETYPE == 'angular':
-                GV = np.dot(self.G[:, :, :], self.V[t, :])
-                GVC = np.einsum('...ij,...j', GV, self.C[s, :])
-                GV_len = np.linalg.norm(GV, axis=1)
-                C_len = np.linalg.norm(self.C[s, :])
-                energy = 1 - (1/pi)*np.arccos(GVC/(GV_len*C_len))
-            else: sys.exit('ERROR: Not implemented')
-        elif switch == 'V':
-            #return over all T
-            if ETYPE == 'dot':
-                GC = np.dot(self.G[r], self.C[s])
-                energy = -np.dot(self.V, GC)
-            elif ETYPE == 'euclidean':
-                GV = np.einsum('...jk,...ik', self.G[r, :, :], self.V)
-                energy = -np.linalg.norm(GV - self.C[s, :], axis=1)
-            elif ETYPE == 'angular':
-                GV = np.einsum('...jk,...ik', self.G[r,:, :], self.V)
-                GVC = np.dot(GV, self.C[s, :])
-                GV_len = np.linalg.norm(GV, axis=1)
-                C_len = np.linalg.norm(self.C[s, :])
-                energy = 1 - (1/pi)*np.arccos(GVC/(GV_len*C_len))
-            else: sys.exit('ERROR: Not implemented')
-        else:
-            print 'ERROR: Cannot parse switch.'
-            sys.exit()
-        return energy
+        return self.E_axes(np.array([triple]), switch)[0]
+
+    def E_axes(self, triples, switch):
+        """
+        E_axis for many triples at once: row m holds the energies over
+        the chosen axis (S, R, T) given the other two entries of triples[m].
+        """
+        return self.energy.axes(self, np.asarray(triples), switch)
+
+    def axes_floats(self, switch):
+        """
+        Roughly how many temporary floats E_axes needs per triple (to size
+        chunks with chunk_length): the energies over the axis, twice, and
+        the G[r] gathered for it ('C', 'V'), or G[r]V[t] for every r ('G').
+        """
+        if switch == 'G':
+            return 2*self.R + self.R*(self.d+1)
+        return 2*self.W + np.prod(self.G.shape[1:])
 
     def E_triple(self, triple):
         """
         The energy of a SINGLE triple.
         """
-        if ETYPE == 'dot':
-            energy = -np.dot(self.V[triple[2]], np.dot(self.G[triple[1]], self.C[triple[0]]))
-        elif ETYPE == 'euclidean':
-            energy = -np.linalg.norm(np.dot(self.G[triple[1]], self.V[triple[2]]) - self.C[triple[0]])
-        elif ETYPE == 'angular':
-            GV = np.dot(self.G[triple[1]], self.V[triple[2]])
-            GVC = np.dot(GV, self.C[triple[0]])
-            GV_len = np.linalg.norm(GV)
-            C_len = np.linalg.norm(self.C[triple[0]])
-            energy = 1 - (1/pi)*np.arccos(GVC/(GV_len*C_len))
-        else: sys.exit('ERROR: Not implemented')
-        return energy
+        return self.energy.pair(self.C[triple[0]], self.project(triple[1], triple[2]))
+
+    def E_rela(self, C_sub, r, V_sub):
+        """
+        Energies of aligned rows of C_sub and V_sub, all under relation r.
+        (this is the inner contraction used by E)
+        """
+        return self.E_projected(C_sub, self.project_rows(V_sub, r))
+
+    def E_projected(self, C_sub, GV):
+        """
+        Energies of aligned rows of C_sub and already-transformed V (see project).
+        """
+        return self.energy.pair(C_sub, GV)
+
+    def E_slab(self, r, s_lo=0, s_hi=None):
+        """
+        Energies of (s, r, t) for s in [s_lo, s_hi) and ALL t, as a
+        (s_hi - s_lo, W) matrix.
+        """
+        return self.energy.slab(self, r, s_lo, s_hi)
+
+    def grad_E_slab(self, r, s_lo, s_hi, weights, energy):
+        """
+        Weighted sums of energy gradients over a slab (see E_slab), without
+        forming per-triple gradient tensors. With w = weights, returns
+            sum_t w[s, t] dE(s, r, t)/dC[s]     for s in the slab, (s_hi-s_lo, d+1)
+            sum_{s, t} w[s, t] dE(s, r, t)/dG[r]                     (G[r].shape)
+            sum_s w[s, t] dE(s, r, t)/dV[t]     for all t,           (W, d+1)
+        'energy' is the matching E_slab output.
+        """
+        return self.energy.grad_cross(self, r, self.C[s_lo:s_hi], weights, energy)
+
+    def slabs(self):
+        """
+        Walks over the full (W, R, W) energy tensor in bounded pieces.
+        Yields (r, s_lo, s_hi, energy) with energy as from E_slab.
+        """
+        step = chunk_length(3*self.W)
+        for r in xrange(self.R):
+            for s_lo in xrange(0, self.W, step):
+                s_hi = min(s_lo + step, self.W)
+                yield r, s_lo, s_hi, self.E_slab(r, s_lo, s_hi)
 
     def E(self, locations=None):
         """
         Just plain old energy between triples.
         locations is an array of triples.
         Outputs a list (same length as 'locations') of energy of each triple.
+        (triples are processed in chunks of bounded size; within a chunk
+        they are laid out in blocks by relation, padded to the biggest, so
+        all of G[r]V[t] is one batched product: see index_blocks and
+        GATHER_FLOATS)
+        If locations is None, gives ALL W*R*W triples, in all_triples order.
         """
-        #C_sub = self.C[locations[:, 0]]
-        #G_sub = self.G[locations[:, 1]]
-        #V_sub = self.V[locations[:, 2]]
-        # this is for Etype == 'dot'
-        # TODO:
-        #   profile speed wrt order
-        #   wrt just looping through locations
-        #   # yolo
-        # profiling...
-        # V1
-        #GC_sub = np.einsum('...ij,...j', G_sub, C_sub)
-        #energy = -np.einsum('...i,...i', V_sub, GC_sub)
-        # V2
-        #energy = np.empty(shape=(len(locations)))
-        #for i in xrange(len(locations)):
-        #    energy[i] = -np.dot(C_sub[i],np.dot(V_sub[i], G_sub[i]))
-        # V3
-        #VG_sub = np.einsum('...i,...ij', V_sub, G_sub)
-        #energy = -np.einsum('...i,...i', VG_sub, C_sub)
-        # V4
-        #energy = map(lambda triple: -np.dot(self.C[triple[0]], np.dot(self.V[triple[2]], self.G[triple[1]])), locations)
-        #energy = np.array(map(lambda (s, r, t): -np.dot(self.C[s], np.dot(self.V[t], self.G[r])), locations))
-        # V5
-        #energy = map(lambda i: -np.dot(V_sub[i], np.dot(G_sub[i], C_sub[i])), xrange(len(locations)))
-        # V6
-        #energy = linn.amap(self.E_triple, locations)
-        # V7
-        #parmz = []
-        #for triple in locations:
-        #    parmz.append(((self.C, self.G, self.V), triple))
-        #energy = map(silly_energy, parmz)
-        # V8
-        #energy = np.empty(shape=len(locations))
-        #for (i, triple) in enumerate(locations):
-        #    energy[i] = self.E_triple(triple)
-        # V9
         if locations is None:
-            W = self.W
-            R = self.R
-            locations = np.array([[s, r, t] for s in xrange(W) for r in xrange(R) for t in xrange(W) ])
+            energy = np.empty(shape=(self.W, self.R, self.W), dtype=np.float)
+            for (r, s_lo, s_hi, slab) in self.slabs():
+                energy[s_lo:s_hi, r, :] = slab
+            return energy.reshape(-1)
+        locations = np.asarray(locations)
         energy = np.empty(shape=len(locations), dtype=np.float)
-        if ETYPE == 'dot':
-            for (i, triple) in enumerate(locations):
-                energy[i] = -np.dot(self.C[triple[0]], 
-                                    np.dot(self.V[triple[2]], 
-                                           self.G[triple[1]]))
-        elif ETYPE == 'euclidean':
-            for (i, triple) in enumerate(locations):
-                energy[i] = -np.linalg.norm(np.dot(self.G[triple[1]], 
-                                                   self.V[triple[2]]) -\
-                                            self.C[triple[0]])
-        elif ETYPE == 'angular':
-            for (i, triple) in enumerate(locations):
-                energy[i] = self.E_triple(triple)
-        else: sys.exit('ERROR: Not implemented')
-        # V10
-        #energy = []
-        #for triple in locations:
-        #    energy.append(-np.dot(self.C[triple[0]], np.dot(self.V[triple[2]], self.G[triple[1]])))
+        # C_sub, V_sub, GV and friends
+        # (the blocks are at most twice the size of the chunk)
+        G_floats = np.prod(self.G.shape[1:])
+        step = chunk_length(8*(self.d+1))
+        for start in xrange(0, len(locations), step):
+            lox = locations[start:start+step]
+            relas, block, place = index_blocks(lox[:, 1], self.R)
+            if not self.cache is None or len(lox)*G_floats < len(relas)*GATHER_FLOATS:
+                # (no need for blocks: just look them up, or gather G[r] per triple,
+                # a few at a time)
+                sub_step = chunk_length(4*(self.d+1) + G_floats)
+                for lo in xrange(0, len(lox), sub_step):
+                    sub = lox[lo:lo+sub_step]
+                    energy[start+lo:start+lo+len(sub)] = self.E_projected(self.C[sub[:, 0]],
+                                                                          self.project(sub[:, 1], sub[:, 2]))
+                continue
+            width = np.max(place) + 1
+            if len(relas)*width > 2*len(lox):
+                # (too lopsided to pad: one relation at a time)
+                E_lox = np.empty(shape=len(lox), dtype=np.float)
+                for (r, which) in index_groups(lox[:, 1], self.R):
+                    E_lox[which] = self.E_rela(self.C[lox[which, 0]], r,
+                                               self.V[lox[which, 2]])
+                energy[start:start+step] = E_lox
+                continue
+            V_blocks = np.zeros(shape=(len(relas), width, self.d+1), dtype=self.V.dtype)
+            V_blocks[block, place] = self.V[lox[:, 2]]
+            GV = self.project_rows(V_blocks, relas.reshape(-1, 1))[block, place]
+            energy[start:start+step] = self.E_projected(self.C[lox[:, 0]], GV)
         return energy
 
+    def top_k(self, queries, switch, k=10, index=None, n_probe=None):
+        """
+        Link prediction: the k best (lowest-energy) completions of each query.
+            switch 'V': queries are (s, r) pairs, gives the best t
+            switch 'C': queries are (r, t) pairs, gives the best s
+            switch 'G': queries are (s, t) pairs, gives the best r
+        Returns (indices, energies), both (M, k), best first.
+        Queries are scored in chunks, each as one E_axes call. With an index
+        (from build_index, 'dot' only) only its candidates get scored.
+        """
+        queries = np.asarray(queries)
+        axis = 'CGV'.index(switch)
+        triples = np.insert(queries, axis, 0, axis=1)
+        if not index is None:
+            if not self.energy.name == 'dot':
+                sys.exit('ERROR: the approximate index needs etype dot.')
+            s, r, t = triples[:, 0], triples[:, 1], triples[:, 2]
+            if switch == 'V':
+                Q = self.relations.left(self.G, r, self.C[s])
+            elif switch == 'C':
+                Q = self.project(r, t)
+            else: sys.exit('ERROR: no index over relations.')
+            best, scores = index.query(Q, k, n_probe)
+            return best, -scores
+        width = self.R if switch == 'G' else self.W
+        best = np.empty(shape=(len(triples), min(k, width)), dtype=np.int)
+        best_energy = np.empty(shape=best.shape, dtype=np.float)
+        step = chunk_length(self.axes_floats(switch))
+        for start in xrange(0, len(triples), step):
+            energy = self.E_axes(triples[start:start+step], switch)
+            best[start:start+step], best_energy[start:start+step] = top_k_rows(energy, k)
+        return best, best_energy
+
+    def build_index(self, switch, n_clusters=None, seed=None):
+        """
+        An approximate index for top_k (see mips_index): over V for
+        switch 'V', over C for switch 'C'. Rebuild it after training.
+        """
+        if switch == 'V':
+            return mips_index(self.V, n_clusters, seed=seed)
+        elif switch == 'C':
+            return mips_index(self.C, n_clusters, seed=seed)
+        else: sys.exit('ERROR: no index over relations.')
+
     def sample(self, seed, K):
         """
         Draws samples from the model, given a (single!) seed.
         (iterates through Gibbs sampling K times)
         """
-        W = self.W
-        R = self.R
-        ss = deepcopy(seed)
+        return self.sample_chains(np.array([seed]), K)[0]
+
+    def sample_chains(self, seeds, K, beta=1.0, rng=np.random):
+        """
+        Advances many Gibbs chains at once, K iterations each.
+        seeds is an (M, 3) array of triples (left alone), returns the new (M, 3).
+        Each chain gets its own random scan order every iteration, as in
+        sample; at each step, all chains resampling the same axis share one
+        E_axes call.
+        beta is an inverse temperature: the chains target exp(-beta*E).
+        With kernels (see KERNELS), energies with a sweep_kernel and dense
+        G do each iteration in one kernel call instead.
+        """
+        chains = np.array(seeds, dtype=np.int)
+        M = len(chains)
+        sweep = None
+        if use_kernels() and self.relations.name == 'dense':
+            sweep = self.energy.sweep_kernel
         for iteration in xrange(K):
-            order = np.random.permutation(3)
-            for triple_drop in order:
-                if triple_drop == 0:
-                    energy = self.E_axis(ss, 'C')
-                    #locs = np.array([ [i, ss[1], ss[2]] for i in xrange(W) ])
-                if triple_drop == 1:
-                    energy = self.E_axis(ss, 'G')
-                    #locs = np.array([ [ss[0], i, ss[2]] for i in xrange(R) ])
-                if triple_drop == 2:
-                    energy = self.E_axis(ss, 'V')
-                    #locs = np.array([ [ss[0], ss[1], i] for i in xrange(W) ])
-                #expmE = np.exp(-self.E(locs))
-                expmE = np.exp(-energy)
-                probs = expmE/np.sum(expmE)
-                samp = np.random.choice(len(probs), p=probs, size=1)[0]
-                ss[triple_drop] = samp
-        return ss
+            # a random permutation of (0, 1, 2) for each chain
+            orders = np.argsort(rng.random_sample(size=(M, 3)), axis=1)
+            if not sweep is None:
+                # (the same uniforms the reference would use, in its order)
+                u = np.empty(shape=(M, 3))
+                for step in xrange(3):
+                    for triple_drop in xrange(3):
+                        which = np.flatnonzero(orders[:, step] == triple_drop)
+                        u[which, step] = rng.random_sample(len(which))
+                get_kernel(sweep)(chains, orders, u, beta, np.asarray(self.C),
+                                  np.asarray(self.G), np.asarray(self.V))
+                continue
+            for step in xrange(3):
+                for (triple_drop, switch) in enumerate('CGV'):
+                    which = np.flatnonzero(orders[:, step] == triple_drop)
+                    if len(which) == 0:
+                        continue
+                    energy = self.E_axes(chains[which], switch)
+                    chains[which, triple_drop] = sample_categorical(-beta*energy, rng)
+        return chains
 
     def get(self):
         """
@@ -446,16 +2178,51 @@ class params(object):
         """
         return (self.C, self.G, self.V)
 
+    def snapshot(self):
+        """
+        A copy of the weights (C, G, V) to read from (energies, sampling)
+        while this one keeps training. The optimiser state is not copied.
+        """
+        frozen = copy(self)
+        frozen.C = np.array(self.C)
+        frozen.G = np.array(self.G)
+        frozen.V = np.array(self.V)
+        frozen.G_version = np.array(self.G_version)
+        frozen.V_version = np.array(self.V_version)
+        if not self.cache is None:
+            frozen.cache = np.array(self.cache)
+            frozen.cache_G_version = np.array(self.cache_G_version)
+            frozen.cache_V_version = np.array(self.cache_V_version)
+        return frozen
+
+    def share_memory(self):
+        """
+        Moves the weights and optimiser state into shared memory, so worker
+        processes forked afterwards all update the same arrays.
+        """
+        # (the version counters too, so every process's cache sees all updates)
+        for name in STATE_ARRAYS + ['G_version', 'V_version']:
+            X = getattr(self, name)
+            X_shared = shared_array(X.shape, X.dtype)
+            X_shared[...] = X
+            setattr(self, name, X_shared)
+        return True
+
     def save(self, filename):
         """
         Method to save the parameters to file.
+        (a .ckpt filename gets a checkpoint: see save_checkpoint)
         """
+        if filename.endswith('.ckpt'):
+            return save_checkpoint(filename, self)
         if not 'XXX' in filename:
             print 'WARNING: Save expects an XXX in the filename. Fixed that for you.'
             filename = filename+'_XXX'
+        # (always written as dense matrices)
+        G = self.relations.to_dense(self.G)
         if '.npy' in filename:
             C_dict = dict(zip(self.words, self.C[:,:-1]))
-            G_dict = dict(zip(self.relas, self.G))
+            G_dict = dict(zip(self.relas, G))
             V_dict = dict(zip(self.words, self.V[:, :-1]))
             np.save(re.sub('XXX','C',filename),C_dict)
             np.save(re.sub('XXX','G',filename),G_dict)
@@ -473,7 +2240,7 @@ class params(object):
                 fV.write(word+' '+' '.join(map(str, self.V[i,:-1]))+'\n')
             for i in xrange(self.R):
                 rela = self.relas[i]
-                fG.write(rela+' '+' '.join(map(str, self.G[i,:-1,:].reshape((self.C.shape[1])*(self.C.shape[1]-1),)))+'\n')
+                fG.write(rela+' '+' '.join(map(str, G[i,:-1,:].reshape((self.C.shape[1])*(self.C.shape[1]-1),)))+'\n')
             fC.close()
             fV.close()
             fG.close()
@@ -490,7 +2257,21 @@ class params(object):
         For .txt the order in the file is actually faithful, but for npy, 
         since they are saved as dictionaries, we cannot guarantee this.
         Sorry!
+        (...unless it's a checkpoint, see save_checkpoint, which keeps the
+        order and the optimiser state, and is memory-mapped copy-on-write)
         """
+        if filename.endswith('.ckpt'):
+            arrays, header = load_checkpoint(filename)
+            self.W, self.R, self.d = header['W'], header['R'], header['d']
+            self.words = header['words']
+            self.relas = header['relas']
+            self.relations = RELATIONS[header.get('relations', 'dense')](self.d, header.get('relation_rank'))
+            if 'etype' in header:
+                self.energy = ENERGIES[header['etype']]()
+            self.flags = header.get('flags', dict())
+            for name in STATE_ARRAYS:
+                setattr(self, name, arrays[name])
+            return True
         if not 'XXX' in filename:
             print 'WARNING: Load expects an XXX in the filename. Fixed that for you.'
             filename = filename+'_XXX'
@@ -556,61 +2337,297 @@ class params(object):
         self.C = deepcopy(C)
         self.G = deepcopy(G)
         self.V = deepcopy(V)
+        self.relations = dense_relations(d)
         return True
 
-def log_likelihood(parameters, data):
+# --- checkpoints --- #
+def jsonable(value):
     """
-    WARNING: Probably don't want to do this most of the time.
-    Requires 'data' to be a full list (not just a generator, I think...)
+    Options (and such) as something json can write.
+    """
+    if isinstance(value, dict):
+        return dict((key, jsonable(val)) for (key, val) in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return map(jsonable, value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def unjsonable(value):
+    """
+    Undoes jsonable, roughly: lists of numbers become arrays again, and
+    unicode becomes str.
+    """
+    if isinstance(value, dict):
+        return dict((str(key), unjsonable(val)) for (key, val) in value.iteritems())
+    if isinstance(value, list):
+        if len(value) > 0 and all(type(val) in (int, long, float) for val in value):
+            return np.array(value)
+        return map(unjsonable, value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def save_checkpoint(path, parameters, options=None, n=0, extra=None, arrays=None):
+    """
+    Writes everything needed to resume training to ONE file: C, G, V, the
+    optimiser state (STATE_ARRAYS), the flags params was made with
+    (trans_rela, fix_words, ...), the vocabulary in index order, options,
+    the example counter n, any 'extra' arrays (dict of name: array) and
+    'meta' (anything json can write) from extra['meta'].
+    Layout: CHECKPOINT_MAGIC, int64 header length, JSON header, then the
+    raw arrays, each aligned to CHECKPOINT_ALIGN bytes (so they can be mapped).
+    Written to a temporary file which is then renamed over path, so a
+    crash never leaves a half-written checkpoint.
+    'arrays' lets you pass a snapshot of the parameter arrays instead of
+    reading them from 'parameters' (see checkpoint_writer).
+    """
+    if arrays is None:
+        arrays = dict((name, getattr(parameters, name)) for name in STATE_ARRAYS)
+    else:
+        arrays = dict(arrays)
+    meta = None
+    if not extra is None:
+        extra = dict(extra)
+        meta = extra.pop('meta', None)
+        for (name, array) in extra.iteritems():
+            arrays['extra_'+name] = array
+    header = {'W':parameters.W, 'R':parameters.R, 'd':parameters.d,
+              'etype':parameters.energy.name,
+              'relations':parameters.relations.name,
+              'relation_rank':parameters.relations.rank,
+              'flags':{'fix_words':bool(parameters.fix_words),
+                       'fix_relas':bool(parameters.fix_relas),
+                       'trans_rela':bool(parameters.trans_rela),
+                       'cache':not parameters.cache is None},
+              'words':list(parameters.words), 'relas':list(parameters.relas),
+              'n':n, 'options':jsonable(options), 'meta':jsonable(meta),
+              'arrays':dict()}
+    # work out where everything goes, given the header length...
+    # (which depends on the offsets, so allow some slack)
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        header['arrays'][name] = {'dtype':array.dtype.str, 'shape':list(array.shape),
+                                  'offset':offset}
+        offset += -(-array.nbytes//CHECKPOINT_ALIGN)*CHECKPOINT_ALIGN
+    header_text = json.dumps(header)
+    start = len(CHECKPOINT_MAGIC) + 8 + len(header_text) + 64
+    start = -(-start//CHECKPOINT_ALIGN)*CHECKPOINT_ALIGN
+    header['start'] = start
+    header_text = json.dumps(header)
+    assert len(CHECKPOINT_MAGIC) + 8 + len(header_text) <= start
+    tmp_path = path+'.tmp'+str(os.getpid())
+    fo = open(tmp_path, 'wb')
+    fo.write(CHECKPOINT_MAGIC)
+    fo.write(np.array([len(header_text)], dtype='<i8').tostring())
+    fo.write(header_text)
+    for name in sorted(arrays):
+        fo.seek(start + header['arrays'][name]['offset'])
+        arrays[name].tofile(fo)
+    fo.flush()
+    os.fsync(fo.fileno())
+    fo.close()
+    os.rename(tmp_path, path)
+    return True
+
+def load_checkpoint(path, mmap=True):
+    """
+    Reads a checkpoint written by save_checkpoint.
+    Returns (arrays, header): arrays is a dict of name: array (extra arrays
+    keep their 'extra_' prefix), header has W, R, d, etype,
+    relations, relation_rank, words, relas, n, options, meta.
+    With mmap, arrays are memory-mapped copy-on-write: nothing is read until
+    it's touched, and changes never go back to the file.
+    """
+    fi = open(path, 'rb')
+    if not fi.read(len(CHECKPOINT_MAGIC)) == CHECKPOINT_MAGIC:
+        sys.exit('ERROR: '+path+' is not a checkpoint.')
+    header_length = int(np.fromfile(fi, dtype='<i8', count=1)[0])
+    header = unjsonable(json.loads(fi.read(header_length)))
+    arrays = dict()
+    for (name, layout) in header['arrays'].iteritems():
+        shape = tuple(layout['shape'])
+        offset = header['start'] + layout['offset']
+        if mmap and np.prod(shape) > 0:
+            arrays[name] = np.memmap(path, dtype=layout['dtype'], mode='c',
+                                     offset=offset, shape=shape)
+        else:
+            fi.seek(offset)
+            arrays[name] = np.fromfile(fi, dtype=layout['dtype'],
+                                       count=int(np.prod(shape))).reshape(shape)
+    fi.close()
+    return arrays, header
+
+class checkpoint_writer(object):
+    """
+    Writes checkpoints from a background thread.
+    write() only copies the parameter arrays (a snapshot), and returns;
+    the thread does the rest. If the previous checkpoint is still being
+    written, write() waits for it first.
+    """
+    def __init__(self):
+        self.thread = None
+    def write(self, path, parameters, options=None, n=0, extra=None):
+        self.wait()
+        arrays = dict((name, np.array(getattr(parameters, name))) for name in STATE_ARRAYS)
+        if not extra is None:
+            extra = dict((name, np.array(val) if isinstance(val, np.ndarray) else deepcopy(val))
+                         for (name, val) in extra.iteritems())
+        options = deepcopy(options)
+        self.thread = threading.Thread(target=save_checkpoint,
+                                       args=(path, parameters, options, n, extra, arrays))
+        self.thread.daemon = True
+        self.thread.start()
+    def wait(self):
+        if not self.thread is None:
+            self.thread.join()
+            self.thread = None
+
+def resume_state(path):
+    """
+    Reads a checkpoint written by train, for train(..., resume=state).
+    Returns (parameters, state): state has the held-out split, the chains,
+    the partial batch, the counters, the position in the epoch, and
+    whatever else train put in the checkpoint's meta.
+    """
+    arrays, header = load_checkpoint(path)
+    if header['meta'] is None:
+        sys.exit('ERROR: '+path+' has no training state to resume.')
+    # (with the flags it was trained with: trans_rela, fix_words, ...)
+    parameters = params(path)
+    state = dict(header['meta'])
+    for name in arrays:
+        if name.startswith('extra_'):
+            state[name[len('extra_'):]] = np.array(arrays[name])
+    return parameters, state
+
+def partition_function(parameters):
+    """
+    log Z, summing exp(-E) over all W*R*W triples.
+    The energy tensor is never held in memory: we walk it slab by slab
+    (see params.slabs) and keep a running log-sum-exp.
+    """
+    logZ = -np.inf
+    for (r, s_lo, s_hi, energy) in parameters.slabs():
+        logZ = np.logaddexp(logZ, logsumexp(-energy))
+    return logZ
+
+def ais_partition_function(parameters, n_chains=100, n_temperatures=100, K=1,
+                           rng=np.random):
+    """
+    Estimates log Z by annealed importance sampling
+    (Neal, http://arxiv.org/abs/physics/9803008): n_chains chains start from
+    uniform triples (beta=0, Z = W*R*W) and are annealed to the model
+    (beta=1) through n_temperatures inverse temperatures, taking K Gibbs
+    sweeps (params.sample_chains) at each.
+    Costs O(n_chains*n_temperatures*K*(2W + R)*d) rather than O(W*R*W*d).
+    Returns (logZ, its standard error).
     """
     W = parameters.W
     R = parameters.R
-    locations = np.array([[s, r, t] for s in xrange(W) for r in xrange(R) for t in xrange(W) ])
-    energy = parameters.E(locations).reshape(W, R, W)
-    logZ = np.log(np.sum(np.exp(-energy)))
-    ll = np.sum([(-energy[s, r, t] - logZ) for s, r, t in data])
+    betas = np.linspace(0, 1, n_temperatures + 1)
+    chains = np.array(zip(rng.randint(0, W, n_chains),
+                          rng.randint(0, R, n_chains),
+                          rng.randint(0, W, n_chains)))
+    log_weights = np.zeros(n_chains)
+    for t in xrange(1, len(betas)):
+        log_weights -= (betas[t] - betas[t-1])*parameters.E(chains)
+        if t < n_temperatures:
+            chains = parameters.sample_chains(chains, K, betas[t], rng)
+    logZ = np.log(W*R*W) + logsumexp(log_weights) - np.log(n_chains)
+    # (delta method: the relative standard error of the mean weight)
+    weights = np.exp(log_weights - np.max(log_weights))
+    logZ_err = np.std(weights)/(np.mean(weights)*np.sqrt(n_chains))
+    return logZ, logZ_err
+
+def log_likelihood(parameters, data, logZ=None):
+    """
+    WARNING: Probably don't want to do this most of the time.
+    (exact log Z costs O(W*R*W*d), although it no longer needs that much memory)
+    'data' is an array of triples, or anything iterable over triples.
+    """
+    if logZ is None:
+        logZ = partition_function(parameters)
+    if isinstance(data, shuffled_triples):
+        data = np.asarray(data)
+    elif not isinstance(data, np.ndarray):
+        data = np.array(list(data))
+    energy = parameters.E(data)
+    ll = -np.sum(energy) - len(data)*logZ
     return ll
 
-def sample_noise(W, R, M):
+def sample_noise(W, R, M, known=None, distribution=None):
     """
     Return M totally random samples.
-    TODO: allow for other noise distribution.
+    (from a noise_distribution, if given: otherwise uniform)
+    With known (a known_triples), samples which are known triples are
+    redrawn (a few times: after that, they stay).
     """
-    noise_samples = np.array(zip(np.random.randint(0, W, M),
-                                 np.random.randint(0, R, M),
-                                 np.random.randint(0, W, M)))
+    if distribution is None:
+        noise_samples = np.array(zip(np.random.randint(0, W, M),
+                                     np.random.randint(0, R, M),
+                                     np.random.randint(0, W, M)))
+    else:
+        noise_samples = distribution.sample(M)
+    if not known is None:
+        for attempt in xrange(10):
+            redo = np.flatnonzero(known.contains(noise_samples))
+            if len(redo) == 0:
+                break
+            noise_samples[redo] = sample_noise(W, R, len(redo), None, distribution)
     return noise_samples
 
+def nce_gradients(parameters, batch, noise_samples, distribution, log_Z, omega,
+                  sparse=False):
+    """
+    Noise-contrastive estimation (Gutmann & Hyvarinen, 2010): the model
+    p(x) = exp(-E(x) - log_Z), with log_Z learned too, has to tell the batch
+    from k = len(noise_samples)/len(batch) times as many noise samples from
+    'distribution' (a noise_distribution). With
+        D(x) = -E(x) - log_Z - log(k q(x))
+    the objective is sum_batch log sigmoid(D) + sum_noise log sigmoid(-D).
+    Returns (delta_data, delta_noise, dlog_Z): the first two as from
+    batch_gradient, for combine_gradients with prefactor 1.
+    """
+    k = float(len(noise_samples))/len(batch)
+    def contrast(triples):
+        return -parameters.E(triples) - log_Z - np.log(k) - distribution.log_prob(triples)
+    data_weights = sigmoid(-contrast(batch))
+    noise_weights = sigmoid(contrast(noise_samples))
+    delta_data = batch_gradient(parameters, batch, omega, sparse, data_weights)
+    delta_noise = batch_gradient(parameters, noise_samples, omega, sparse, noise_weights)
+    dlog_Z = np.sum(noise_weights) - np.sum(data_weights)
+    return delta_data, delta_noise, dlog_Z
+
 def Z_gradient(parameters):
     """
     Calculates EXACT gradient of the partition function.
-    NOTE: intractable most of the time.
+    NOTE: still O(W*R*W*d), but it's all matrix products now.
     This should possibly belong to the parameters.
+    Two passes over the energy slabs: one for log Z, then one contracting
+    p(s, r, t) with C, G, V (e.g. dC[s] = sum_{r,t} p(s,r,t) V[t]G[r] for 'dot').
     """
     W = parameters.W
-    R = parameters.R
     d = parameters.d
-    locations = np.array([[s, r, t] for s in xrange(W) for r in xrange(R) for t in xrange(W) ])
-    # get exponentiated energy
-    energy = parameters.E(locations).reshape(W, R, W)
-    expmE = np.exp(-energy)
-    Z = np.sum(expmE)
-    # get gradients
-    dE_C, dE_G, dE_V = parameters.grad_E(locations)
+    logZ = partition_function(parameters)
     # empty arrays
-    dC_partition = np.zeros(shape=(W, d+1))
-    dG_partition = np.zeros(shape=(R, d+1, d+1))
-    dV_partition = np.zeros(shape=(W, d+1))
-    for (n, (s, r, t)) in enumerate(locations):
-        dC_partition[s, :] -= dE_C[n, :]*expmE[s, r, t]
-        dG_partition[r, :, :] -= dE_G[n, :, :]*expmE[s, r, t]
-        dV_partition[t, :] -= dE_V[n, :]*expmE[s, r, t]
-    dC_partition /= Z
-    dG_partition /= Z
-    dV_partition /= Z
+    dC_partition = np.zeros(shape=(W, d+1), dtype=parameters.dtype)
+    dG_partition = np.zeros(shape=parameters.G.shape, dtype=parameters.dtype)
+    dV_partition = np.zeros(shape=(W, d+1), dtype=parameters.dtype)
+    for (r, s_lo, s_hi, energy) in parameters.slabs():
+        probs = np.exp(-energy - logZ).astype(parameters.dtype)
+        dE_C, dE_G, dE_V = parameters.grad_E_slab(r, s_lo, s_hi, probs, energy)
+        dC_partition[s_lo:s_hi] -= dE_C
+        dG_partition[r] -= dE_G
+        dV_partition -= dE_V
+    parameters.relations.constrain(dG_partition)
     return dC_partition, dG_partition, dV_partition
 
-def batch_gradient(parameters, batch, omega):
+def batch_gradient(parameters, batch, omega, sparse=False, weights=None):
     """
     Gradient is a difference of contributions from:
     1. data distribution (batch of training examples)
@@ -622,19 +2639,31 @@ def batch_gradient(parameters, batch, omega):
     omega is a vector of weights associated with relationships
     (length = R)
     each gradient contribution is scaled by omega_r
+    (and by weights[i], for the ith triple, if given)
+
+    With sparse=True, returns only the touched rows:
+    ((rows_C, dC_rows), (rows_G, dG_rows), (rows_V, dV_rows))
     """
+    dE_C_batch, dE_G_batch, dE_V_batch = parameters.grad_E(batch)
+    prefactor = -np.asarray(omega, dtype=np.float)[batch[:, 1]]
+    if not weights is None:
+        prefactor = prefactor*weights
+    # (so the gradients come out in the parameters' precision)
+    prefactor = prefactor.astype(parameters.dtype)
+    grad_C = group_sum(batch[:, 0], prefactor.reshape(-1, 1)*dE_C_batch)
+    grad_G = group_sum(batch[:, 1], prefactor.reshape((-1,)+(1,)*(dE_G_batch.ndim-1))*dE_G_batch)
+    grad_V = group_sum(batch[:, 2], prefactor.reshape(-1, 1)*dE_V_batch)
+    parameters.relations.constrain(grad_G[1])
+    if sparse:
+        return (grad_C, grad_G, grad_V)
     W = parameters.W
-    R = parameters.R
     d = parameters.d
-    dC_batch = np.zeros(shape=(W, d+1))
-    dG_batch = np.zeros(shape=(R, d+1, d+1))
-    dV_batch = np.zeros(shape=(W, d+1))
-    dE_C_batch, dE_G_batch, dE_V_batch = parameters.grad_E(batch)
-    for (i, (s, r, t)) in enumerate(batch):
-        prefactor = omega[r]
-        dC_batch[s, :] -= prefactor*dE_C_batch[i]
-        dG_batch[r, :, :] -= prefactor*dE_G_batch[i]
-        dV_batch[t, :] -= prefactor*dE_V_batch[i]
+    dC_batch = np.zeros(shape=(W, d+1), dtype=parameters.dtype)
+    dG_batch = np.zeros(shape=parameters.G.shape, dtype=parameters.dtype)
+    dV_batch = np.zeros(shape=(W, d+1), dtype=parameters.dtype)
+    dC_batch[grad_C[0]] = grad_C[1]
+    dG_batch[grad_G[0]] = grad_G[1]
+    dV_batch[grad_V[0]] = grad_V[1]
     return (dC_batch, dG_batch, dV_batch)
 
 def combine_gradients(delta_data, delta_model, prefactor):
@@ -647,29 +2676,291 @@ def combine_gradients(delta_data, delta_model, prefactor):
     # impose constraints
     delta_C[:, -1] = 0
     delta_V[:, -1] = 0
-    delta_G[:, -1, :] = 0
-    delta_G[0, :, :] = 0
+    # (batch_gradient and Z_gradient constrain delta_G as the relations need)
+    delta_G[0] = 0
     return delta_C, delta_G, delta_V
 
+def combine_sparse_gradients(delta_data, delta_model, prefactor):
+    """
+    combine_gradients, for gradients from batch_gradient(..., sparse=True).
+    """
+    combined = []
+    for ((rows_data, grad_data), (rows_model, grad_model)) in zip(delta_data, delta_model):
+        rows = np.concatenate([rows_data, rows_model])
+        grad = np.concatenate([grad_data, -prefactor*grad_model])
+        combined.append(group_sum(rows, grad))
+    (rows_C, delta_C), (rows_G, delta_G), (rows_V, delta_V) = combined
+    # impose constraints
+    delta_C[:, -1] = 0
+    delta_V[:, -1] = 0
+    delta_G[rows_G == 0] = 0
+    return (rows_C, delta_C), (rows_G, delta_G), (rows_V, delta_V)
+
 def permute_batch(word_perm, rela_perm, batch):
     """
     This function will take a list of triples and a pair of KNOWN permutations
     (W -> W', R -> R')
     and output triples after applying the transformation.
     """
-    mapped_batch = np.empty(shape=batch.shape)
-    for (i, (s, r, t)) in enumerate(batch):
-        mapped_batch[i] = (word_perm[s], rela_perm[r], word_perm[t])
+    batch = np.asarray(batch)
+    word_map = np.array([word_perm[w] for w in xrange(len(word_perm))])
+    rela_map = np.array([rela_perm[r] for r in xrange(len(rela_perm))])
+    mapped_batch = np.empty(shape=batch.shape, dtype=batch.dtype)
+    mapped_batch[:, 0] = word_map[batch[:, 0]]
+    mapped_batch[:, 1] = rela_map[batch[:, 1]]
+    mapped_batch[:, 2] = word_map[batch[:, 2]]
     return mapped_batch
 
+def diagnostics(parameters, batch, samples, vali_set, perm_vali_batch, rng=np.random):
+    """
+    The energy/length columns of the logfile:
+        data_energy, model_energy, valiset_energy, random_energy, perm_energy,
+        C_lens, G_lens, V_lens
+    (model_energy is 'NA' if there are no persistent samples)
+    """
+    W = parameters.W
+    R = parameters.R
+    data_energy = np.mean(parameters.E(batch))
+    vali_energy = np.mean(parameters.E(vali_set))
+    random_lox = np.array(zip(rng.randint(0, W, 100),
+                              rng.randint(0, R, 100),
+                              rng.randint(0, W, 100)))
+    rand_energy = np.mean(parameters.E(random_lox))
+    # so this is different to the rand, cause it's a permuted version of the validation set
+    perm_energy = np.mean(parameters.E(perm_vali_batch))
+    if samples is None:
+        model_energy = 'NA'
+    else:
+        model_energy = np.mean(parameters.E(samples))
+    # get some vector lengths
+    # TODO: make this more elegant
+    see, gee, vee = parameters.get()
+    gee = parameters.relations.to_dense(gee[random_lox[:, 1]])
+    C_lens = np.mean(np.linalg.norm(see[random_lox[:, 0], :-1], axis=1))
+    G_lens = np.mean(np.linalg.norm(gee[:, :-1], axis=(1,2)))
+    V_lens = np.mean(np.linalg.norm(vee[random_lox[:, 2], :-1], axis=1))
+    return [data_energy, model_energy, vali_energy,
+            rand_energy, perm_energy,
+            C_lens, G_lens, V_lens]
+
+def write_logline(logf, logline, VERBOSE=True):
+    """
+    Records a line of diagnostics (n, time, ll, then as from diagnostics).
+    """
+    if VERBOSE:
+        print '\t', logline[0],
+        for val in logline[1:]:
+            if type(val) == str: 
+                print '\t', val,
+            else:
+                print '\t','%.3f' % val,
+    print ''
+    logf.write('\t'.join(map(str, logline))+'\n')
+    logf.flush()
+
+class diagnostics_writer(object):
+    """
+    Works out the logfile lines (diagnostics, and log_likelihood if asked)
+    from a background thread, on snapshots of the parameters, so training
+    doesn't wait for them. At most 'backlog' lines can be waiting: beyond
+    that, submit() waits for a free place, or with drop=True skips the
+    line (and counts it in self.skipped), so the logfile has gaps.
+    With backlog=0 it's all done in submit(), as before.
+    Without calculate_ll, the ll column is the held-out set's, with log Z
+    from ais_partition_function(parameters, *ais) (unless ais is None);
+    n, log Z and the error bars then go to ais_logf too.
+    With a rank_logf, n and the held-out set's evaluate_ranking go there
+    (filtered by the known triples, if given).
+    """
+    def __init__(self, logf, training_data, vali_set, perm_vali_batch,
+                 backlog=2, VERBOSE=True, ais=None, ais_logf=None, rank_logf=None,
+                 known=None, drop=False):
+        self.logf = logf
+        self.drop = drop
+        self.known = known
+        self.ais = ais
+        self.ais_logf = ais_logf
+        self.rank_logf = rank_logf
+        self.training_data = training_data
+        self.vali_set = vali_set
+        self.perm_vali_batch = perm_vali_batch
+        self.VERBOSE = VERBOSE
+        self.skipped = 0
+        self.error = None
+        if backlog > 0:
+            # own random numbers, so training's aren't disturbed
+            self.rng = np.random.RandomState()
+            self.queue = Queue.Queue(maxsize=backlog)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.rng = np.random
+            self.thread = None
+    def submit(self, n, t, parameters, batch, samples, calculate_ll):
+        """
+        A logfile line for example n, time t.
+        """
+        if self.thread is None:
+            self.logline(n, t, parameters, batch, samples, calculate_ll)
+            return True
+        if self.drop and self.queue.full():
+            self.skipped += 1
+            return False
+        if not samples is None:
+            samples = np.array(samples)
+        self.queue.put((n, t, parameters.snapshot(), np.array(batch), samples, calculate_ll))
+        return True
+    def logline(self, n, t, parameters, batch, samples, calculate_ll):
+        if calculate_ll:
+            ll = log_likelihood(parameters, self.training_data)
+        elif not self.ais is None:
+            logZ, logZ_err = ais_partition_function(parameters, *self.ais, rng=self.rng)
+            ll = log_likelihood(parameters, self.vali_set, logZ)
+            if not self.ais_logf is None:
+                self.ais_logf.write('\t'.join(map(str, [n, logZ, logZ_err, ll, len(self.vali_set)*logZ_err]))+'\n')
+                self.ais_logf.flush()
+        else:
+            ll = 'NA'
+        logline = [n, t, ll] + diagnostics(parameters, batch, samples, self.vali_set,
+                                           self.perm_vali_batch, self.rng)
+        write_logline(self.logf, logline, self.VERBOSE)
+        if not self.rank_logf is None:
+            metrics = evaluate_ranking(parameters, self.vali_set, known=self.known)
+            self.rank_logf.write('\t'.join(map(str, [n] + [metrics[column] for column in RANK_COLUMNS]))+'\n')
+            self.rank_logf.flush()
+    def run(self):
+        # (numpy's error settings are per thread)
+        np.seterr(all='raise')
+        np.seterr(under='warn')
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if not self.error is None:
+                # (one went wrong: drop the rest)
+                self.skipped += 1
+                continue
+            try:
+                self.logline(*job)
+            except Exception as error:
+                # report it when we close
+                self.error = error
+    def close(self):
+        """
+        Waits for the lines still queued, then re-raises any error they hit.
+        """
+        if not self.thread is None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.skipped > 0:
+            print 'WARNING: skipped', self.skipped, 'diagnostics lines (they fell behind).'
+        if not self.error is None:
+            raise self.error
+
+def training_setup(training_data, start_parameters, options, NOISE=False):
+    """
+    The options train and train_hogwild share: makes the parameters (unless
+    start_parameters already is a params), opens the log files and works
+    out known triples and the NOISE distribution. Each optional setting is
+    read on its own, with its own default.
+    RETURNS:
+        dict of what the training loops need from them
+    """
+    name = options['name']
+    D = options['diagnostics_rate']
+    calculate_ll = options['calculate_ll']
+    setup = dict()
+    # YMMV
+    setup['vali_set_size'] = options.get('vali_set_size', 1000)
+    setup['vali_method'] = options.get('vali_method', 'random')
+    # e.g. 'float32' (and state_dtype 'float64' for the optimiser;
+    # default: the same as dtype)
+    dtype = options.get('dtype', None)
+    state_dtype = options.get('state_dtype', None)
+    # how to store G (see RELATIONS), e.g. 'translation'
+    relations = options.get('relations', None)
+    # (for 'lowrank')
+    relation_rank = options.get('relation_rank', None)
+    # energy model (see ENERGIES; default ETYPE)
+    etype = options.get('etype', None)
+    if not type(start_parameters) == params:
+        parameters = params(start_parameters, dtype=dtype, state_dtype=state_dtype,
+                            relations=relations, relation_rank=relation_rank,
+                            etype=etype)
+    else:
+        parameters = start_parameters
+    if options.get('projection_cache', False) and parameters.cache is None:
+        parameters.enable_cache()
+    setup['parameters'] = parameters
+    # how many diagnostics lines may wait for the background thread
+    # (0: work them out in line, as training goes)
+    setup['diagnostics_backlog'] = options.get('diagnostics_backlog', 2)
+    # skip diagnostics lines rather than wait, when the backlog is full
+    setup['diagnostics_drop'] = options.get('diagnostics_drop', False)
+    # AIS budget, for the ll column when not calculate_ll (0: no AIS)
+    # (off unless asked for: it costs a lot at every diagnostics line)
+    ais_chains = options.get('ais_chains', 0)
+    ais_temperatures = options.get('ais_temperatures', 100)
+    # link prediction metrics on the held-out set, to <name>_ranks.txt
+    rank_eval = options.get('rank_eval', False)
+    # (ranks among unknown triples only)
+    rank_filtered = options.get('rank_filtered', True)
+    # never use known triples as NOISE samples
+    reject_known = options.get('reject_known', False)
+    # where NOISE samples come from (see noise_distribution)
+    noise_kind = options.get('noise', 'uniform')
+    noise_power = float(options.get('noise_power', 1.0))
+    # NOISE samples stand in for model samples ('contrast'), or 'nce'
+    nce = NOISE and options.get('noise_objective', 'contrast') == 'nce'
+    setup['nce'] = nce
+    # diagnostic things
+    setup['logf'] = open(name+'_logfile.txt','a')
+    if ais_chains > 0 and not calculate_ll and D > 0:
+        # (AIS only stands in for the exact ll)
+        setup['ais'] = (ais_chains, ais_temperatures)
+        setup['ais_logf'] = open(name+'_ais.txt','a')
+    else:
+        setup['ais'], setup['ais_logf'] = None, None
+    if rank_eval:
+        setup['rank_logf'] = open(name+'_ranks.txt','a')
+    else:
+        setup['rank_logf'] = None
+    setup['checkpoints'] = checkpoint_writer()
+    W = parameters.W
+    R = parameters.R
+    if (rank_eval and rank_filtered) or (NOISE and reject_known):
+        known = known_triples(training_data, W, R)
+    else:
+        known = None
+    setup['rank_known'] = known if rank_filtered else None
+    setup['noise_known'] = known if reject_known else None
+    if NOISE and (nce or not noise_kind == 'uniform'):
+        setup['noise'] = noise_distribution(training_data, W, R, noise_kind, noise_power)
+    else:
+        setup['noise'] = None
+    if 'nce_log_Z' in options:
+        setup['nce_log_Z'] = options['nce_log_Z']
+    else:
+        # (what it would be if all energies were 0)
+        setup['nce_log_Z'] = np.log(W*R*W)
+    return setup
+
 def train(training_data, start_parameters, options,
-          EXACT=False, PERSISTENT=True, NOISE=False, VERBOSE=True):
+          EXACT=False, PERSISTENT=True, NOISE=False, VERBOSE=True,
+          vali_set=None, resume=None):
     """
     Perform (stochastic) gradient ascent on the parameters.
     INPUTS:
         training_data       iterator of examples.
         start_parameters    triple of (C, G, V)
         options             dictionary
+        vali_set            held-out triples, if already chosen (e.g. in an
+                            earlier epoch), otherwise we choose them
+        resume              state from resume_state, to pick up where a
+                            checkpoint left off (training_data must be in
+                            the same order as then: same shuffle seed)
     RETURNS:
         parameters      triple of (C, G, V)
         [[ some measure of convergence ]]
@@ -696,21 +2987,28 @@ def train(training_data, start_parameters, options,
     print name
     offset = options['offset']
     try:
-        vali_set_size = options['vali_set_size']
+        # only update rows seen in the batch (not with EXACT, which is dense)
+        sparse = options['sparse_updates'] and not EXACT
     except KeyError:
-        # YMMV
-        vali_set_size = 1000
+        sparse = False
     # initialise
-    vali_set = set()
     batch = np.empty(shape=(B, 3),dtype=np.int)
     # TODO: proper sample initialisation
     samples = np.zeros(shape=(M, 3),dtype=np.int)
-    if not type(start_parameters) == params:
-        parameters = params(start_parameters)
-    else:
-        parameters = start_parameters
-    # diagnostic things
-    logf = open(name+'_logfile.txt','a')
+    setup = training_setup(training_data, start_parameters, options, NOISE)
+    parameters = setup['parameters']
+    vali_set_size = setup['vali_set_size']
+    vali_method = setup['vali_method']
+    diagnostics_backlog = setup['diagnostics_backlog']
+    diagnostics_drop = setup['diagnostics_drop']
+    logf, ais, ais_logf, rank_logf = (setup['logf'], setup['ais'],
+                                      setup['ais_logf'], setup['rank_logf'])
+    checkpoints = setup['checkpoints']
+    rank_known = setup['rank_known']
+    noise_known = setup['noise_known']
+    noise = setup['noise']
+    nce = setup['nce']
+    nce_log_Z = setup['nce_log_Z']
     W = parameters.W
     R = parameters.R
     try:
@@ -719,120 +3017,345 @@ def train(training_data, start_parameters, options,
     except KeyError:
         # no downweighting!
         omega = [1]*R
-    # a fixed permutation, for testing my strange likelihood ratio thing
-    W_perm = dict(enumerate(np.random.permutation(W)))
-    R_perm = dict(enumerate(np.random.permutation(R)))
+    n = 0
+    position = 0
+    if not resume is None:
+        vali_set = resume['vali_set']
+        perm_vali_batch = resume['perm_vali_batch']
+        samples = resume['samples']
+        batch[:, :] = resume['batch']
+        n = resume['n']
+        position = resume['position']
+        mu_t = resume['mu_t']
+        alpha = resume['alpha']
+        offset = resume['offset']
+        options['offset'] = offset
+        # (so the sampler carries on exactly as it would have)
+        np.random.set_state(tuple(resume['rng']))
+        nce_log_Z = resume['nce_log_Z']
+        if not EXACT and not nce and n >= S:
+            # (as it was when the samples were drawn, not as the parameters are now)
+            try:
+                if sparse:
+                    delta_model = tuple((resume['model_rows_'+which], resume['model_'+which])
+                                        for which in 'CGV')
+                else:
+                    delta_model = tuple(resume['model_'+which] for which in 'CGV')
+            except KeyError:
+                # (older checkpoints don't have it)
+                delta_model = batch_gradient(parameters, samples, omega, sparse)
+            prefactor = float(B)/len(samples)
+        if VERBOSE: print 'Resuming after', n, 'examples, at row', position
+    # held-out triples (chosen up front, checked a chunk at a time)
+    if vali_set is None:
+        vali_set, vali_keys = holdout_split(training_data, vali_set_size, W, R,
+                                            method=vali_method)
+    else:
+        vali_keys = np.sort(pack_triples(vali_set, W, R))
+    if resume is None:
+        # a fixed permutation, for testing my strange likelihood ratio thing
+        W_perm = dict(enumerate(np.random.permutation(W)))
+        R_perm = dict(enumerate(np.random.permutation(R)))
+        perm_vali_batch = permute_batch(W_perm, R_perm, vali_set)
+    def training_state(position):
+        # everything needed to carry on from row 'position' of training_data
+        state = {'vali_set':vali_set, 'perm_vali_batch':perm_vali_batch,
+                 'samples':samples, 'batch':batch,
+                 'meta':{'n':n, 'position':position, 'mu_t':mu_t, 'alpha':alpha,
+                         'offset':offset, 'epoch':options.get('epoch', 0),
+                         'shuffle_seed':options.get('shuffle_seed', None),
+                         'nce_log_Z':nce_log_Z, 'rng':np.random.get_state()}}
+        if not EXACT and not nce and n >= S:
+            # (the model gradient lives until the next samples are drawn)
+            for (which, part) in zip('CGV', delta_model):
+                if sparse:
+                    state['model_rows_'+which], state['model_'+which] = part
+                else:
+                    state['model_'+which] = part
+        return state
+    logger = diagnostics_writer(logf, training_data, vali_set, perm_vali_batch,
+                                diagnostics_backlog, VERBOSE, ais, ais_logf, rank_logf,
+                                rank_known, diagnostics_drop)
     # record sampling frequencies
     #sampled_counts = dict((i, 0) for i in xrange(W))
-    n = 0
     t0 = time.time()
-    for example in training_data:
-        if len(vali_set) < vali_set_size:
-            vali_set.add(tuple(example))
-            continue
-        if len(vali_set) == vali_set_size:
-            perm_vali_batch = permute_batch(W_perm, R_perm, np.array(list(vali_set)))
+    for chunk in triple_chunks(training_data, lo=position):
+        chunk_lo = position
+        position += len(chunk)
         # explanation for this:
         # in W=5 dataset, if you exclude vali_set, you lose a significant %
         # of the training data...
         if not W == 5:
-            if tuple(example) in vali_set:
-                continue
-        batch[n%B, :] = example
-        #yolo
-        #sampled_counts[example[0]] +=1
-        #sampled_counts[example[2]] +=1
-        n += 1
-        if not EXACT and n%S == 0:
-            if NOISE:
-                samples = sample_noise(W, R, S)
-            else:
-                if not PERSISTENT: samples[:, :] = batch[np.random.choice(B, M), :]
-                for (m, samp) in enumerate(samples):
-                    sampled_triple = parameters.sample(samp, K)
-                    samples[m, :] = sampled_triple
-                    # yolo
-                    #sampled_counts[sampled_triple[0]] += 1
-                    #sampled_counts[sampled_triple[2]] += 1
-            # yolo
-            #print sampled_counts.values()
-            delta_model = batch_gradient(parameters, samples, omega)
-            prefactor = float(B)/len(samples)
-        if n%B == 0 and n > S:
-            if EXACT:
-                delta_model = Z_gradient(parameters)
-                prefactor = float(B)
-            delta_data = batch_gradient(parameters, batch, omega)
-            delta_params = combine_gradients(delta_data, delta_model, prefactor)
-            if ADAM:
-                mu_t = mu_t*LAMBDA
-            else:
-                if not 0 in tau:
-                    alpha = alpha0/(1+(n+offset)/(tau*B))
-            parameters.update(delta_params, alpha, mu_t, nu)
-        if D > 0:
-            # if D == 0 or < 0, this means NO DIAGNOSTICS ARE RUN
-            # the reason this is an option is clearly speed
-            if n%D == 0 and n > B and n > S:
-                t = time.time() - t0
-                if calculate_ll:
-                    ll = log_likelihood(parameters, training_data)
-                    #ll = log_likelihood(parameters, vali_set)
-                else:
-                    ll = 'NA'
-                data_energy = np.mean(parameters.E(batch))
-                vali_energy = np.mean(parameters.E(np.array(list(vali_set))))
-                random_lox = np.array(zip(np.random.randint(0, W, 100),
-                                          np.random.randint(0, R, 100),
-                                          np.random.randint(0, W, 100)))
-                rand_energy = np.mean(parameters.E(random_lox))
-                # so this is different to the rand, cause it's a permuted version of the validation set
-                perm_energy = np.mean(parameters.E(perm_vali_batch))
-                if PERSISTENT:
-                    model_energy = np.mean(parameters.E(samples))
+            rows = np.flatnonzero(~in_sorted(pack_triples(chunk, W, R), vali_keys))
+        else:
+            rows = np.arange(len(chunk))
+        for (row, example) in zip(rows, chunk[rows]):
+            batch[n%B, :] = example
+            #yolo
+            #sampled_counts[example[0]] +=1
+            #sampled_counts[example[2]] +=1
+            n += 1
+            if not EXACT and n%S == 0:
+                if NOISE:
+                    samples = sample_noise(W, R, S, noise_known, noise)
                 else:
-                    model_energy = 'NA'
-                # get some vector lengths
-                # TODO: make this more elegant
-                see, gee, vee = parameters.get()
-                C_lens = np.mean(np.linalg.norm(see[random_lox[:, 0], :-1], axis=1))
-                G_lens = np.mean(np.linalg.norm(gee[random_lox[:, 1], :-1], axis=(1,2)))
-                V_lens = np.mean(np.linalg.norm(vee[random_lox[:, 2], :-1], axis=1))
-                # record to logfile
-                logline = [n + offset, t, ll, 
-                           data_energy, model_energy, vali_energy,
-                           rand_energy, perm_energy,
-                           C_lens, G_lens, V_lens]
-                if VERBOSE:
-                    print '\t', logline[0],
-                    for val in logline[1:]:
-                        if type(val) == str: 
-                            print '\t', val,
-                        else:
-                            print '\t','%.3f' % val,
-                print ''
-                logf.write('\t'.join(map(str, logline))+'\n')
-                logf.flush()
+                    if not PERSISTENT: samples[:, :] = batch[np.random.choice(B, M), :]
+                    samples = parameters.sample_chains(samples, K)
                 # yolo
-                #if np.random.random() < 0.2:
-                #    for r in xrange(R):
-                #        anim_fo = open('animations/anim_R'+str(r)+'_'+str(n).zfill(5)+'.txt','w')
-                #        for w in xrange(W):
-                #            #anim_fo.write('C'+str(w)+' '+' '.join(map(str, parameters.C[w, :-1]))+'\n')
-                #            anim_fo.write('V'+str(w)+' '+' '.join(map(str, np.dot(parameters.G[r, :, :],parameters.V[w, :])[:-1]))+'\n')
-                #        anim_fo.close()
-                # endyolo
-                # yololo
-                # record performance on devset (nips2013)
-                #devset_accuracy(devpath, devlogpath, parameters, n + offset)
-                # endyolo
-            if n%(D*10) == 0:
-                parameters.save(name+'_XXX.npy')
-                if VERBOSE:
-                    print 'Saved parameters to', name+'_XXX.npy'
+                #print sampled_counts.values()
+                if not nce:
+                    delta_model = batch_gradient(parameters, samples, omega, sparse)
+                    prefactor = float(B)/len(samples)
+            if n%B == 0 and n > S:
+                if EXACT:
+                    delta_model = Z_gradient(parameters)
+                    prefactor = float(B)
+                if nce:
+                    # (the weights depend on the current parameters)
+                    delta_data, delta_model, dlog_Z = nce_gradients(parameters, batch, samples, noise,
+                                                                    nce_log_Z, omega, sparse)
+                    prefactor = 1.0
+                    nce_log_Z += alpha[0]*dlog_Z/B
+                else:
+                    delta_data = batch_gradient(parameters, batch, omega, sparse)
+                if ADAM:
+                    mu_t = mu_t*LAMBDA
+                else:
+                    if not 0 in tau:
+                        alpha = alpha0/(1+(n+offset)/(tau*B))
+                if sparse:
+                    delta_params = combine_sparse_gradients(delta_data, delta_model, prefactor)
+                    parameters.update_sparse(delta_params, alpha, mu_t, nu)
+                else:
+                    delta_params = combine_gradients(delta_data, delta_model, prefactor)
+                    parameters.update(delta_params, alpha, mu_t, nu)
+            if D > 0:
+                # if D == 0 or < 0, this means NO DIAGNOSTICS ARE RUN
+                # the reason this is an option is clearly speed
+                if n%D == 0 and n > B and n > S:
+                    if sparse: parameters.catch_up(alpha, mu_t, nu)
+                    t = time.time() - t0
+                    if not PERSISTENT:
+                        model_samples = None
+                    else:
+                        model_samples = samples
+                    logger.submit(n + offset, t, parameters, batch, model_samples, calculate_ll)
+                    # yolo
+                    #if np.random.random() < 0.2:
+                    #    for r in xrange(R):
+                    #        anim_fo = open('animations/anim_R'+str(r)+'_'+str(n).zfill(5)+'.txt','w')
+                    #        for w in xrange(W):
+                    #            #anim_fo.write('C'+str(w)+' '+' '.join(map(str, parameters.C[w, :-1]))+'\n')
+                    #            anim_fo.write('V'+str(w)+' '+' '.join(map(str, np.dot(parameters.G[r, :, :],parameters.V[w, :])[:-1]))+'\n')
+                    #        anim_fo.close()
+                    # endyolo
+                if n%(D*10) == 0:
+                    if sparse: parameters.catch_up(alpha, mu_t, nu)
+                    checkpoints.write(name+'.ckpt', parameters, options, n + offset,
+                                      training_state(chunk_lo + row + 1))
+                    if VERBOSE:
+                        print 'Checkpointing to', name+'.ckpt'
+    logger.close()
     logf.close()
+    if not ais_logf is None: ais_logf.close()
+    if not rank_logf is None: rank_logf.close()
     if VERBOSE: print 'Training done,', n, 'examples seen.'
+    if sparse: parameters.catch_up(alpha, mu_t, nu)
+    checkpoints.wait()
+    save_checkpoint(name+'.ckpt', parameters, options, n + offset,
+                    training_state(position))
     parameters.save(name+'_XXX.npy')
     options['alpha'] = alpha
+    if nce: options['nce_log_Z'] = nce_log_Z
+    options['offset'] += n
+    return vali_set
+
+def hogwild_worker(worker, training_data, lo, hi, parameters, options,
+                   vali_keys, progress, PERSISTENT=True, NOISE=False, noise_known=None,
+                   noise=None, nce_log_Z=None, schedule=None):
+    """
+    The inside of train_hogwild: SGD over rows [lo, hi) of training_data,
+    with this worker's own samples, making lock-free sparse updates to the
+    (shared) parameters. Counts examples seen in progress[worker].
+    With nce_log_Z (a shared array of one), NOISE mode does NCE, updating
+    nce_log_Z[0] along with the rest.
+    schedule (a shared (n_workers, 2, 3) array) gets this worker's current
+    alpha and mu_t, for the final catch_up.
+    """
+    # don't all draw the same random numbers as the parent
+    np.random.seed()
+    B = options['batch_size']
+    S = options['sampling_rate']
+    M = options['num_samples']
+    K = options['gibbs_iterations']
+    alpha0 = options['alpha']
+    mu = options['mu']
+    try:
+        nu =  options['nu']
+    except KeyError:
+        nu = None
+    mu_t = mu[:]
+    alpha = alpha0[:]
+    tau = options['tau']
+    offset = options['offset']
+    W = parameters.W
+    R = parameters.R
+    n_workers = len(progress)
+    try:
+        omega = options['omega']
+        assert len(omega) == R
+    except KeyError:
+        # no downweighting!
+        omega = [1]*R
+    batch = np.empty(shape=(B, 3),dtype=np.int)
+    samples = np.zeros(shape=(M, 3),dtype=np.int)
+    n = 0
+    for chunk in triple_chunks(training_data, lo, hi):
+        if not W == 5:
+            chunk = chunk[~in_sorted(pack_triples(chunk, W, R), vali_keys)]
+        for example in chunk:
+            batch[n%B, :] = example
+            n += 1
+            if n%S == 0:
+                if NOISE:
+                    samples = sample_noise(W, R, S, noise_known, noise)
+                else:
+                    if not PERSISTENT: samples[:, :] = batch[np.random.choice(B, M), :]
+                    samples = parameters.sample_chains(samples, K)
+                if nce_log_Z is None:
+                    delta_model = batch_gradient(parameters, samples, omega, sparse=True)
+                    prefactor = float(B)/len(samples)
+            if n%B == 0 and n > S:
+                if nce_log_Z is None:
+                    delta_data = batch_gradient(parameters, batch, omega, sparse=True)
+                else:
+                    delta_data, delta_model, dlog_Z = nce_gradients(parameters, batch, samples, noise,
+                                                                    nce_log_Z[0], omega, sparse=True)
+                    prefactor = 1.0
+                    nce_log_Z[0] += alpha[0]*dlog_Z/B
+                if ADAM:
+                    mu_t = mu_t*LAMBDA
+                else:
+                    if not 0 in tau:
+                        alpha = alpha0/(1+(n*n_workers+offset)/(tau*B))
+                delta_params = combine_sparse_gradients(delta_data, delta_model, prefactor)
+                parameters.update_sparse(delta_params, alpha, mu_t, nu)
+                progress[worker] = n
+                if not schedule is None:
+                    schedule[worker, 0] = alpha
+                    schedule[worker, 1] = mu_t
+    progress[worker] = n
+
+def train_hogwild(training_data, start_parameters, options, n_workers,
+                  PERSISTENT=True, NOISE=False, VERBOSE=True, vali_set=None):
+    """
+    Like train, but with n_workers processes each doing SGD on a shard of
+    the training data, all updating the same shared-memory parameters
+    without locks (Hogwild!, http://arxiv.org/abs/1106.5730).
+    Updates are sparse (see params.update_sparse); no EXACT mode.
+    This process just watches: it writes diagnostics every D examples
+    (model_energy is NA, the chains belong to the workers) and saves.
+    training_data should be an array, memmap or shuffled_triples.
+    vali_set is as for train. Checkpoints have no training state: hogwild
+    runs can't be resumed.
+    """
+    if NOISE: PERSISTENT=False
+    B = options['batch_size']
+    S = options['sampling_rate']
+    D = options['diagnostics_rate']
+    calculate_ll = options['calculate_ll']
+    name = options['name']
+    print name
+    offset = options['offset']
+    if isinstance(training_data, data_stream):
+        training_data = training_data.acquire_all()
+    setup = training_setup(training_data, start_parameters, options, NOISE)
+    parameters = setup['parameters']
+    parameters.share_memory()
+    vali_set_size = setup['vali_set_size']
+    vali_method = setup['vali_method']
+    diagnostics_backlog = setup['diagnostics_backlog']
+    diagnostics_drop = setup['diagnostics_drop']
+    logf, ais, ais_logf, rank_logf = (setup['logf'], setup['ais'],
+                                      setup['ais_logf'], setup['rank_logf'])
+    checkpoints = setup['checkpoints']
+    rank_known = setup['rank_known']
+    noise_known = setup['noise_known']
+    noise = setup['noise']
+    nce = setup['nce']
+    nce_log_Z = setup['nce_log_Z']
+    W = parameters.W
+    R = parameters.R
+    if vali_set is None:
+        vali_set, vali_keys = holdout_split(training_data, vali_set_size, W, R,
+                                            method=vali_method)
+    else:
+        vali_keys = np.sort(pack_triples(vali_set, W, R))
+    W_perm = dict(enumerate(np.random.permutation(W)))
+    R_perm = dict(enumerate(np.random.permutation(R)))
+    perm_vali_batch = permute_batch(W_perm, R_perm, vali_set)
+    logger = diagnostics_writer(logf, training_data, vali_set, perm_vali_batch,
+                                diagnostics_backlog, VERBOSE, ais, ais_logf, rank_logf,
+                                rank_known, diagnostics_drop)
+    if nce:
+        # (shared, like the parameters)
+        nce_log_Z = np.zeros(shape=1) + nce_log_Z
+        shared_log_Z = shared_array(nce_log_Z.shape)
+        shared_log_Z[:] = nce_log_Z
+    else:
+        shared_log_Z = None
+    # go!
+    progress = multiprocessing.RawArray('l', n_workers)
+    # (each worker's alpha and mu_t, as they decay)
+    schedule = shared_array((n_workers, 2, 3))
+    schedule[:, 0] = options['alpha']
+    schedule[:, 1] = options['mu']
+    shards = np.linspace(0, len(training_data), n_workers + 1).astype(np.int)
+    workers = []
+    for worker in xrange(n_workers):
+        p = multiprocessing.Process(target=hogwild_worker,
+                                    args=(worker, training_data,
+                                          shards[worker], shards[worker+1],
+                                          parameters, options, vali_keys,
+                                          progress, PERSISTENT, NOISE, noise_known,
+                                          noise, shared_log_Z, schedule))
+        p.start()
+        workers.append(p)
+    t0 = time.time()
+    next_diagnostics = max(D, B+1, S+1)
+    next_save = D*10
+    n = 0
+    while any(p.is_alive() for p in workers):
+        time.sleep(0.1)
+        n = sum(progress)
+        if D > 0 and n >= next_diagnostics:
+            next_diagnostics = (n/D + 1)*D
+            # (no catch_up while the workers run: they catch rows up
+            # themselves, so the diagnostics see some rows a little stale)
+            t = time.time() - t0
+            batch = np.asarray(training_data[np.random.randint(0, len(training_data), B)])
+            logger.submit(n + offset, t, parameters, batch, None, calculate_ll)
+        if D > 0 and n >= next_save:
+            next_save = (n/(D*10) + 1)*D*10
+            checkpoints.write(name+'.ckpt', parameters, options, n + offset)
+            if VERBOSE:
+                print 'Checkpointing to', name+'.ckpt'
+    for p in workers:
+        p.join()
+        if not p.exitcode == 0:
+            print 'WARNING: a worker exited with code', p.exitcode
+    n = sum(progress)
+    logger.close()
+    logf.close()
+    if not ais_logf is None: ais_logf.close()
+    if not rank_logf is None: rank_logf.close()
+    if VERBOSE: print 'Training done,', n, 'examples seen,', '%.0f' % (n/(time.time() - t0)), 'per second.'
+    # (the workers are done: catch up with the schedule of the furthest along)
+    latest = np.argmax(progress)
+    parameters.catch_up(schedule[latest, 0], schedule[latest, 1], options.get('nu'))
+    checkpoints.wait()
+    save_checkpoint(name+'.ckpt', parameters, options, n + offset)
+    parameters.save(name+'_XXX.npy')
+    if nce: options['nce_log_Z'] = shared_log_Z[0]
     options['offset'] += n
     return vali_set